@@ -1,31 +1,54 @@
 from __future__ import unicode_literals
 from collections import OrderedDict
-from fnmatch import fnmatch
+from collections import namedtuple
 from lazy import lazy
 from ploy.common import BaseMaster, StartupScriptMixin
 try:
     from ploy.common import InstanceExecutor
 except ImportError:
     from ploy.common import Executor as InstanceExecutor
+from ploy.common import format_fingerprint
 from ploy.common import parse_ssh_keygen
-from ploy.config import BaseMassager, value_asbool
+from ploy.common import sorted_choices
+from ploy.common import shjoin
+from ploy.config import BaseMassager, PathMassager, value_asbool
 from ploy.plain import Instance as PlainInstance
 from ploy.proxy import ProxyInstance
+import argparse
+import atexit
+import base64
+import binascii
+import functools
+import hashlib
+import json
 import logging
-import paramiko
+import os
 import re
 import socket
+import string
+import struct
 import sys
+import threading
 import time
 
 
 log = logging.getLogger('ploy_ezjail')
 
 
+try:
+    monotonic = time.monotonic
+except AttributeError:  # pragma: nocover - Python 2.7
+    monotonic = time.time
+
+
 class EzjailError(Exception):
     pass
 
 
+def random_token():
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
 rc_startup = """#!/bin/sh
 #
 # BEFORE: DAEMON
@@ -54,6 +77,286 @@ run_rc_command "$1"
 """
 
 
+# command used on the host to decode stdin data embedded in shell scripts
+b64decode_args = ('b64decode', '-r')
+
+
+def b64lines(data, width=76):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    encoded = base64.b64encode(data).decode('ascii')
+    return [encoded[i:i + width] for i in range(0, len(encoded), width)]
+
+
+Step = namedtuple('Step', 'args stdin error')
+StepResult = namedtuple('StepResult', 'step rc out err')
+BulkResult = namedtuple('BulkResult', 'instance result error')
+
+
+class RemoteSteps(object):
+    """A sequence of commands to run on the host of a master.
+
+    The steps are either executed one by one, or combined into a single
+    shell script which is sent to the host with one exec and reports the
+    outcome of each step back. Execution stops at the first failing step
+    which has an ``error`` message set."""
+
+    def __init__(self):
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add(self, args, stdin=None, error=None):
+        self.steps.append(Step(tuple(args), stdin, error))
+
+    def run(self, master, batched=False):
+        if not self.steps:
+            return []
+        if batched:
+            return self._run_batched(master)
+        results = []
+        for step in self.steps:
+            rc, out, err = master._exec(*step.args, stdin=step.stdin)
+            results.append(StepResult(step, rc, out, err))
+            if rc != 0 and step.error:
+                break
+        return results
+
+    def script(self, token):
+        marker = 'PLOY-%s' % token
+        lines = [
+            'ploy_err=$(mktemp "${TMPDIR:-/tmp}/ploy_ezjail.XXXXXX") || exit 1',
+            "trap 'rm -f \"$ploy_err\"' EXIT"]
+        for index, step in enumerate(self.steps):
+            cmd = shjoin(step.args)
+            lines.append("echo '%s begin %d'" % (marker, index))
+            if step.stdin is None:
+                lines.append('%s </dev/null 2>"$ploy_err"' % cmd)
+            else:
+                lines.append("%s <<'%s' | %s 2>\"$ploy_err\"" % (
+                    shjoin(b64decode_args), marker, cmd))
+                lines.extend(b64lines(step.stdin))
+                lines.append(marker)
+            lines.extend([
+                'ploy_rc=$?',
+                'echo',
+                "echo '%s stderr %d'" % (marker, index),
+                'cat "$ploy_err"',
+                'echo',
+                'echo "%s end %d $ploy_rc"' % (marker, index)])
+            if step.error:
+                lines.append('[ $ploy_rc -eq 0 ] || exit $ploy_rc')
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _run_batched(self, master):
+        token = random_token()
+        rc, out, err = master._exec(
+            'sh', '-s', stdin=self.script(token).encode('utf-8'))
+        marker = ('PLOY-%s' % token).encode('ascii')
+        regexp = re.compile(b''.join([
+            marker, br' begin (\d+)\n(.*?)\n',
+            marker, br' stderr \1\n(.*?)\n',
+            marker, br' end \1 (\d+)\n']), re.DOTALL)
+        results = []
+        for match in regexp.finditer(out):
+            step = self.steps[int(match.group(1))]
+            results.append(StepResult(
+                step, int(match.group(4)), match.group(2), match.group(3)))
+        if not results and rc != 0:
+            msg = out.strip() + b'\n' + err.strip()
+            raise EzjailError(msg.decode('utf-8').strip())
+        return results
+
+
+_operations = threading.local()
+
+
+class operation(object):
+    """Tag the remote commands run in this thread with ``name``.
+
+    Can be used as a context manager or as a decorator. When operations
+    are nested, the outermost one is used."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if not hasattr(_operations, 'stack'):
+            _operations.stack = []
+        _operations.stack.append(self.name)
+        return self
+
+    def __exit__(self, *args):
+        _operations.stack.pop()
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def current_operation():
+    stack = getattr(_operations, 'stack', None)
+    if stack:
+        return stack[0]
+
+
+def _read_ssh_string(data, offset):
+    (length,) = struct.unpack('>I', data[offset:offset + 4])
+    offset = offset + 4
+    if offset + length > len(data):
+        raise ValueError("Truncated key data.")
+    return data[offset:offset + length], offset + length
+
+
+def _mpint_bits(value):
+    if not value:
+        return 0
+    return int(binascii.hexlify(value), 16).bit_length()
+
+
+public_key_types = {
+    'ssh-ed25519': ('ed25519', 256),
+    'sk-ssh-ed25519@openssh.com': ('ed25519-sk', 256),
+    'ecdsa-sha2-nistp256': ('ecdsa', 256),
+    'ecdsa-sha2-nistp384': ('ecdsa', 384),
+    'ecdsa-sha2-nistp521': ('ecdsa', 521),
+    'sk-ecdsa-sha2-nistp256@openssh.com': ('ecdsa-sk', 256)}
+
+
+def parse_public_key(line):
+    """Return fingerprint info like ``ssh-keygen -l`` for a line in
+    OpenSSH public key format, or ``None`` if it can't be handled."""
+    parts = line.split()
+    if len(parts) < 2:
+        return None
+    try:
+        blob = base64.b64decode(parts[1].encode('ascii'))
+        name, offset = _read_ssh_string(blob, 0)
+        name = name.decode('ascii')
+        if name == 'ssh-rsa':
+            e, offset = _read_ssh_string(blob, offset)
+            n, offset = _read_ssh_string(blob, offset)
+            (keytype, keylen) = ('rsa', _mpint_bits(n))
+        elif name == 'ssh-dss':
+            p, offset = _read_ssh_string(blob, offset)
+            (keytype, keylen) = ('dsa', _mpint_bits(p))
+        elif name in public_key_types:
+            (keytype, keylen) = public_key_types[name]
+        else:
+            return None
+    except (binascii.Error, struct.error, TypeError, ValueError):
+        return None
+    return dict(
+        fingerprint=('sha256', hashlib.sha256(blob).digest()),
+        keylen=keylen,
+        keytype=keytype)
+
+
+# runs as root on the host, so only regular files which aren't symlinks
+# are read and their size is limited, anything in the jail root may have
+# been put there by root inside the jail
+public_keys_script = """[ -L "$0/etc" ] || [ -L "$0/etc/ssh" ] && exit 0
+for f in "$0"/etc/ssh/ssh_host*_key.pub; do
+    if [ -f "$f" ] && [ ! -L "$f" ]; then
+        head -c 16384 "$f"
+        echo
+    fi
+done
+exit 0
+"""
+
+
+def ezjail_safename(name):
+    """Return the name ezjail uses for the jail, its config file and the
+    variables in it for the hostname ``name``."""
+    return re.sub('[^A-Za-z0-9]', '_', name)
+
+
+# prints the state, jid and root directory of the jail, image jails which
+# are attached but not running are reported as ``attached``, ezjail-admin
+# list shows them with status ``?A``
+jail_state_script = """if info=$(jls -j "$0" jid path 2>/dev/null); then
+    echo "running $info"
+    exit 0
+fi
+conf="/usr/local/etc/ezjail/$0"
+[ -e "$conf" ] || conf="$conf.norun"
+if [ -e "$conf" ]; then
+    . "$conf"
+    eval "image=\\$jail_$0_image root=\\$jail_$0_rootdir"
+    root=${root%/}
+    if [ -n "$image" ] && mount -p | awk '{print $2}' | grep -qxF "$root"; then
+        echo "attached N/A $root"
+    else
+        echo "stopped N/A $root"
+    fi
+else
+    echo unavailable
+fi
+"""
+
+
+upload_file_script = 'cat - > "$0.ploy" && chmod "$1" "$0.ploy" && mv "$0.ploy" "$0"'
+
+
+file_hashes_script = """for f in "$@"; do
+    sha256 -q "$f" 2>/dev/null || echo -
+done
+"""
+
+
+def content_hash(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+# the host keys of the snapshot are removed from the clone, so sshd creates
+# new ones on the first start instead of all clones sharing the same keys
+clone_jail_script = """zfs clone "$0" "$1" || exit
+root=$(zfs get -H -o value mountpoint "$1")
+if [ -d "$root/etc/ssh" ] && [ ! -L "$root/etc" ] && [ ! -L "$root/etc/ssh" ]; then
+    rm -f "$root"/etc/ssh/ssh_host_*key "$root"/etc/ssh/ssh_host_*key.pub
+fi
+"$2" create -c zfs -x "$3" "$4" && exit
+rc=$?
+zfs destroy "$1"
+exit $rc
+"""
+
+
+missing_dirs_script = """for d in "$@"; do
+    [ -d "$d" ] || echo "$d"
+done
+"""
+
+
+replace_file_script = 'cat - > "$0.ploy" && mv "$0.ploy" "$0"'
+
+
+def apply_substitutions(content, substitutions):
+    """Apply ``(regexp, replacement)`` pairs to each line of ``content``
+    like ``sed -e 's/regexp/replacement/'`` would."""
+    lines = content.split('\n')
+    for regexp, replacement in substitutions:
+        lines = [
+            regexp.sub(lambda m, r=replacement: r, line, count=1)
+            for line in lines]
+    return '\n'.join(lines)
+
+
+fingerprints_script = """for f in /etc/ssh/ssh_host*_key.pub; do
+    [ -e "$f" ] && ssh-keygen -lf "$f"
+done
+exit 0
+"""
+
+
 class Instance(PlainInstance, StartupScriptMixin):
     sectiongroupname = 'ez-instance'
 
@@ -80,60 +383,73 @@ class Instance(PlainInstance, StartupScriptMixin):
     def get_host(self):
         return self.config.get('host', self.get_ip())
 
+    @operation('fingerprint')
     def get_fingerprint(self):
-        status = self._status()
-        if status == 'unavailable':
-            log.info("Instance '%s' unavailable", self.id)
-            sys.exit(1)
-        if status != 'running':
-            log.info("Instance state: %s", status)
-            sys.exit(1)
+        for info in self.get_fingerprints():
+            if info['keytype'] == 'rsa':
+                return format_fingerprint(info['fingerprint'])
         rc, out, err = self.master.ezjail_admin('console', name=self._name, cmd='ssh-keygen -lf /etc/ssh/ssh_host_rsa_key.pub')
         info = out.split()
         return info[1]
 
+    def _get_fingerprints_from_root(self, root):
+        rc, out, err = self.master._exec(
+            'sh', '-c', public_keys_script, root.rstrip('/'))
+        if rc != 0:
+            return []
+        result = []
+        for line in out.decode('utf-8').splitlines():
+            info = parse_public_key(line)
+            if info is not None:
+                result.append(info)
+        return result
+
+    def _get_fingerprints_from_jail(self, jid):
+        # ezjail-admin console splits the command on whitespace without
+        # regard to quoting, so the jail is entered with jexec directly,
+        # using the jid as the jail name is the safename of ezjail
+        rc, out, err = self.master._exec(
+            'jexec', jid, 'sh', '-c', fingerprints_script)
+        result = []
+        for key in parse_ssh_keygen(out.decode('utf-8')):
+            result.append(dict(
+                fingerprint=key.fingerprint,
+                keylen=key.keylen,
+                keytype=key.keytype))
+        return result
+
+    @operation('fingerprint')
     def get_fingerprints(self):
-        status = self._status()
+        status, jid, root = self.master.jail_info(self._name)
         if status == 'unavailable':
             log.info("Instance '%s' unavailable", self.id)
             sys.exit(1)
         if status != 'running':
             log.info("Instance state: %s", status)
             sys.exit(1)
-        result = []
-        rc, out, err = self.master.ezjail_admin(
-            'console', name=self._name,
-            cmd='ls /etc/ssh/')
-        if rc != 0:
-            return result
-        pub_key_names = list(
-            x for x in out.decode('utf-8').splitlines()
-            if fnmatch(x, 'ssh_host*_key.pub'))
-        for pub_key_name in pub_key_names:
-            rc, out, err = self.master.ezjail_admin(
-                'console', name=self._name,
-                cmd='ssh-keygen -lf /etc/ssh/%s' % pub_key_name)
-            if rc != 0:
-                continue
-            (key,) = parse_ssh_keygen(out.decode('utf-8'))
-            info = dict(
-                fingerprint=key.fingerprint,
-                keylen=key.keylen,
-                keytype=key.keytype)
-            result.append(info)
-        return result
+        cached = self.master._fingerprints.get(self._name)
+        if cached is not None and cached[0] == jid:
+            return list(cached[1])
+        result = self._get_fingerprints_from_root(root)
+        if not result:
+            result = self._get_fingerprints_from_jail(jid)
+        if result:
+            self.master._fingerprints[self._name] = (jid, result)
+        return list(result)
 
     def get_massagers(self):
         return get_instance_massagers()
 
+    @operation('init_ssh_key')
     def init_ssh_key(self, user=None):
+        from paramiko import SSHException
         status = self._status()
         if status == 'unavailable':
             log.error("Instance '%s' unavailable", self.uid)
-            raise paramiko.SSHException()
+            raise SSHException()
         if status != 'running':
             log.error("Instance state for '%s': %s", self.uid, status)
-            raise paramiko.SSHException()
+            raise SSHException()
         if 'proxyhost' not in self.config:
             self.config['proxyhost'] = self.master.id
         if 'proxycommand' not in self.config:
@@ -143,19 +459,12 @@ class Instance(PlainInstance, StartupScriptMixin):
 
     def _status(self, jails=None):
         if jails is None:
-            jails = self.master.ezjail_admin('list')
+            return self.master.jail_state(self._name)
         if self._name not in jails:
             return 'unavailable'
-        jail = jails[self._name]
-        status = jail['status']
-        if len(status) != 2 or status[0] not in 'DIEBZ' or status[1] not in 'RAS':
-            raise EzjailError("Invalid jail status '%s' for '%s'" % (status, self._name))
-        if status[1] == 'R':
-            return 'running'
-        elif status[1] == 'S':
-            return 'stopped'
-        raise EzjailError("Don't know how to handle mounted but not running jail '%s'" % self._name)
+        return jails[self._name].state
 
+    @operation('status')
     def status(self):
         try:
             jails = self.master.ezjail_admin('list')
@@ -170,10 +479,10 @@ class Instance(PlainInstance, StartupScriptMixin):
             log.info("Instance state: %s", status)
             return
         log.info("Instance running.")
-        log.info("Instances jail id: %s" % jails[self._name]['jid'])
+        log.info("Instances jail id: %s" % jails[self._name].jid)
         if self._name != self.id:
             log.info("Instances jail name: %s" % self._name)
-        log.info("Instances jail ip: %s" % jails[self._name]['ip'])
+        log.info("Instances jail ip: %s" % jails[self._name].ip)
 
     def _get_jail_config_rc(self, name):
         name = name.lower()
@@ -188,84 +497,183 @@ class Instance(PlainInstance, StartupScriptMixin):
             result = [value]
         return " ".join(result)
 
-    def start(self, overrides=None):
+    def _get_jail_config_substitutions(self):
+        substitutions = []
+        for rc_name in ('BEFORE', 'PROVIDE', 'REQUIRE'):
+            rc_value = self._get_jail_config_rc(rc_name)
+            if rc_value is not None:
+                substitutions.append((
+                    re.compile('# %s:.*$' % rc_name),
+                    '# %s: %s' % (rc_name, rc_value)))
+        for key in self.config.keys():
+            if not key.startswith('jail_'):
+                continue
+            export_value = self.config[key]
+            export_name = key.replace('jail_', 'jail_%s_' % self._name, 1)
+            substitutions.append((
+                re.compile('^export %s=.*$' % re.escape(export_name)),
+                'export %s="%s"' % (export_name, export_value)))
+        return substitutions
+
+    def _read_jail_files(self, config_path, fstab_path, dirs):
+        """Read the ezjail config and fstab of the jail and check which of
+        the given directories are missing with one exec on the host.
+
+        Files which can't be read are returned as ``None``."""
+        paths = [x for x in (config_path, fstab_path) if x is not None]
+        steps = RemoteSteps()
+        for path in paths:
+            steps.add(('cat', path))
+        steps.add(('sh', '-c', missing_dirs_script, 'sh') + tuple(dirs))
+        try:
+            results = steps.run(self.master, batched=True)
+        except EzjailError as e:
+            log.error("Couldn't read jail configuration: %s", e)
+            sys.exit(1)
+        if len(results) != len(steps) or results[-1].rc != 0:
+            log.error("Couldn't read jail configuration.")
+            sys.exit(1)
+        contents = {}
+        for path, result in zip(paths, results):
+            if result.rc == 0:
+                contents[path] = result.out.decode('utf-8')
+        missing_dirs = set(results[-1].out.decode('utf-8').splitlines())
+        return (
+            contents.get(config_path),
+            contents.get(fstab_path),
+            missing_dirs)
+
+    def _run_steps(self, steps):
+        try:
+            results = steps.run(self.master, batched=self.master.batch_provisioning)
+        except EzjailError as e:
+            log.error("Couldn't run commands on '%s':", self.master.id)
+            log.error(e.args[0])
+            sys.exit(1)
+        except socket.error as e:
+            log.error("Couldn't connect to instance [%s]:\n%s", self.master.instance.config_id, e)
+            sys.exit(1)
+        if results and results[-1].rc != 0 and results[-1].step.error:
+            log.error(results[-1].step.error)
+            log.error(results[-1].err.decode('utf-8', 'replace'))
+            sys.exit(1)
+        if len(results) < len(steps):
+            log.error(
+                "Commands on '%s' stopped after %d of %d steps.",
+                self.master.id, len(results), len(steps))
+            sys.exit(1)
+        return results
+
+    def _get_flavour(self):
+        flavour = self.config.get('ezjail-flavour')
+        if 'ezjail-flavour' not in self.config and 'flavour' in self.config:
+            # TODO deprecate
+            flavour = self.config.get('flavour')
+        if not flavour:
+            flavour = None
+        return flavour
+
+    def _get_clone(self):
+        clone = self.config.get('ezjail-clone')
+        if not clone:
+            return None
+        return clone.format(
+            zfs=self.master.zfs,
+            flavour=self._get_flavour() or '',
+            name=self._name)
+
+    def _startup_files(self, jail, startup_script):
+        return [
+            ('%s/etc/startup_script' % jail.root,
+             startup_script,
+             "Startup script creation failed."),
+            ('%s/etc/rc.d/ploy_startup_script' % jail.root,
+             rc_startup,
+             "Startup rc script creation failed.")]
+
+    def _check_startup_hashes(self):
+        # only a cloned jail can already contain the startup files
+        return self._get_clone() is not None
+
+    def _startup_steps(self, jail, startup_script, hashes=None):
+        """Return the ``(args, stdin, error)`` steps which install the
+        startup script in ``jail``.
+
+        Files are replaced atomically. If ``hashes`` of the files on the
+        host are given, files which already have the content are skipped."""
+        steps = []
+        for path, data, error in self._startup_files(jail, startup_script):
+            if hashes is not None and hashes.get(path) == content_hash(data):
+                continue
+            steps.append((
+                ('sh', '-c', upload_file_script, path, '0700'), data, error))
+        return steps
+
+    def _create(self, steps, overrides=None):
+        startup_script = self.startup_script(overrides=overrides)
+        log.info("Creating instance '%s'", self.id)
+        if 'ip' not in self.config:
+            log.error("No IP address set for instance '%s'", self.id)
+            sys.exit(1)
+        try:
+            self.master.ezjail_admin(
+                'create',
+                name=self._name,
+                ip=self.config['ip'],
+                flavour=self._get_flavour(),
+                clone=self._get_clone())
+        except EzjailError as e:
+            for line in e.args[0].splitlines():
+                log.error(line)
+            sys.exit(1)
         jails = self.master.ezjail_admin('list')
+        jail = jails.get(self._name)
+        hashes = None
+        if self._check_startup_hashes():
+            hashes = self.master.file_hashes(
+                x[0] for x in self._startup_files(jail, startup_script))
+        for args, stdin, error in self._startup_steps(jail, startup_script, hashes):
+            steps.add(args, stdin=stdin, error=error)
+        return jails, startup_script
+
+    @operation('create')
+    def create(self, overrides=None, jails=None):
+        if jails is None:
+            jails = self.master.ezjail_admin('list')
+        status = self._status(jails)
+        if status != 'unavailable':
+            log.info("Instance state: %s", status)
+            log.info("Instance already created")
+            return
+        steps = RemoteSteps()
+        self._create(steps, overrides=overrides)
+        self._run_steps(steps)
+        return True
+
+    @operation('start')
+    def start(self, overrides=None, jails=None):
+        if jails is None:
+            jails = self.master.ezjail_admin('list')
         status = self._status(jails)
         startup_script = None
+        steps = RemoteSteps()
         if status == 'unavailable':
-            startup_script = self.startup_script(overrides=overrides)
-            log.info("Creating instance '%s'", self.id)
-            if 'ip' not in self.config:
-                log.error("No IP address set for instance '%s'", self.id)
-                sys.exit(1)
-            try:
-                flavour = self.config.get('ezjail-flavour')
-                if 'ezjail-flavour' not in self.config and 'flavour' in self.config:
-                    # TODO deprecate
-                    flavour = self.config.get('flavour')
-                if not flavour:
-                    flavour = None
-                self.master.ezjail_admin(
-                    'create',
-                    name=self._name,
-                    ip=self.config['ip'],
-                    flavour=flavour)
-            except EzjailError as e:
-                for line in e.args[0].splitlines():
-                    log.error(line)
-                sys.exit(1)
-            jails = self.master.ezjail_admin('list')
-            jail = jails.get(self._name)
-            startup_dest = '%s/etc/startup_script' % jail['root']
-            rc, out, err = self.master._exec(
-                'sh', '-c', 'cat - > "%s"' % startup_dest,
-                stdin=startup_script)
-            if rc != 0:
-                log.error("Startup script creation failed.")
-                log.error(err)
-                sys.exit(1)
-            rc, out, err = self.master._exec("chmod", "0700", startup_dest)
-            if rc != 0:
-                log.error("Startup script chmod failed.")
-                log.error(err)
-                sys.exit(1)
-            rc_startup_dest = '%s/etc/rc.d/ploy_startup_script' % jail['root']
-            rc, out, err = self.master._exec(
-                'sh', '-c', 'cat - > "%s"' % rc_startup_dest,
-                stdin=rc_startup)
-            if rc != 0:
-                log.error("Startup rc script creation failed.")
-                log.error(err)
-                sys.exit(1)
-            rc, out, err = self.master._exec("chmod", "0700", rc_startup_dest)
-            if rc != 0:
-                log.error("Startup rc script chmod failed.")
-                log.error(err)
-                sys.exit(1)
+            jails, startup_script = self._create(steps, overrides=overrides)
             status = self._status(jails)
         if status != 'stopped':
+            self._run_steps(steps)
             log.info("Instance state: %s", status)
             log.info("Instance already started")
             return True
 
-        for rc_name in ('BEFORE', 'PROVIDE', 'REQUIRE'):
-            rc_value = self._get_jail_config_rc(rc_name)
-            if rc_value is not None:
-                self.master._exec(
-                    "sed", "-i", "", "-e",
-                    "s/\\# %s:.*$/\\# %s: %s/" % (rc_name, rc_name, rc_value),
-                    "/usr/local/etc/ezjail/%s" % self._name)
-
-        for key in self.config.keys():
-            if not key.startswith('jail_'):
-                continue
-            export_value = self.config[key]
-            export_name = key.replace('jail_', 'jail_%s_' % self._name, 1)
-            self.master._exec(
-                "sed", "-i", "", "-e",
-                "s/^export %s=.*$/export %s=\"%s\"/" % (export_name, export_name, export_value),
-                "/usr/local/etc/ezjail/%s" % self._name)
-
+        jail_config = '/usr/local/etc/ezjail/%s' % self._name
+        jail_fstab = '/etc/fstab.%s' % self._name
+        jail_root = jails.get(self._name).root.rstrip('/')
+        # look up the used ZFS filesystems together
+        self.master.zfs.resolve(set(
+            name
+            for mount in self.config.get('mounts', [])
+            for name in zfs_references(mount['src'])))
         mounts = []
         for mount in self.config.get('mounts', []):
             src = mount['src'].format(
@@ -273,35 +681,54 @@ class Instance(PlainInstance, StartupScriptMixin):
                 name=self._name)
             dst = mount['dst'].format(
                 name=self._name)
-            create_mount = mount.get('create', False)
-            mounts.append(dict(src=src, dst=dst, ro=mount.get('ro', False)))
-            if create_mount:
-                rc, out, err = self.master._exec("mkdir", "-p", src)
-                if rc != 0:
-                    log.error("Couldn't create source directory '%s' for mountpoint '%s'." % src, mount['src'])
-                    log.error(err)
-                    sys.exit(1)
+            mounts.append(dict(
+                src=src, dst='%s%s' % (jail_root, dst),
+                create=mount.get('create', False),
+                orig_src=mount['src'],
+                ro=mount.get('ro', False)))
+        dirs = [x['src'] for x in mounts if x['create']]
+        dirs.extend(x['dst'] for x in mounts)
+        config, fstab, missing_dirs = self._read_jail_files(
+            jail_config, jail_fstab if mounts else None, dirs)
+
+        if config is None:
+            log.warning("Couldn't read ezjail config '%s'.", jail_config)
+        else:
+            new_config = apply_substitutions(
+                config, self._get_jail_config_substitutions())
+            if new_config != config:
+                steps.add(
+                    ('sh', '-c', replace_file_script, jail_config),
+                    stdin=new_config,
+                    error="Couldn't write ezjail config '%s'." % jail_config)
+
         if mounts:
-            jail = jails.get(self._name)
-            jail_fstab = '/etc/fstab.%s' % self._name
-            jail_root = jail['root'].rstrip('/')
             log.info("Setting up mount points")
-            rc, out, err = self.master._exec("head", "-n", "1", jail_fstab)
-            fstab = out.decode('utf-8').splitlines()
-            fstab = fstab[:1]
-            fstab.append('# mount points from ploy')
             for mount in mounts:
-                self.master._exec(
-                    "mkdir", "-p", "%s%s" % (jail_root, mount['dst']))
+                if mount['create'] and mount['src'] in missing_dirs:
+                    steps.add(
+                        ("mkdir", "-p", mount['src']),
+                        error="Couldn't create source directory '%s' for mountpoint '%s'." % (mount['src'], mount['orig_src']))
+            new_fstab = ['# mount points from ploy']
+            for mount in mounts:
+                if mount['dst'] in missing_dirs:
+                    steps.add(("mkdir", "-p", mount['dst']))
                 if mount['ro']:
                     mode = 'ro'
                 else:
                     mode = 'rw'
-                fstab.append('%s %s%s nullfs %s 0 0' % (mount['src'], jail_root, mount['dst'], mode))
-            fstab.append('')
-            rc, out, err = self.master._exec(
-                'sh', '-c', 'cat - > "%s"' % jail_fstab,
-                stdin='\n'.join(fstab))
+                new_fstab.append('%s %s nullfs %s 0 0' % (mount['src'], mount['dst'], mode))
+            new_fstab.append('')
+            # keep the first line written by ezjail and replace the rest
+            if fstab:
+                new_fstab.insert(0, fstab.split('\n', 1)[0])
+            new_fstab = '\n'.join(new_fstab)
+            if new_fstab != fstab:
+                steps.add(
+                    ('sh', '-c', replace_file_script, jail_fstab),
+                    stdin=new_fstab,
+                    error="Couldn't write fstab '%s'." % jail_fstab)
+        self._run_steps(steps)
         if startup_script:
             log.info("Starting instance '%s' with startup script, this can take a while.", self.id)
         else:
@@ -310,13 +737,15 @@ class Instance(PlainInstance, StartupScriptMixin):
             self.master.ezjail_admin(
                 'start',
                 name=self._name)
+            self.master.wait_for_jail(self._name, 'running')
         except EzjailError as e:
             for line in e.args[0].splitlines():
                 log.error(line)
             sys.exit(1)
 
-    def stop(self, overrides=None):
-        status = self._status()
+    @operation('stop')
+    def stop(self, overrides=None, jails=None):
+        status = self._status(jails)
         if status == 'unavailable':
             log.info("Instance '%s' unavailable", self.id)
             return
@@ -328,8 +757,8 @@ class Instance(PlainInstance, StartupScriptMixin):
         self.master.ezjail_admin('stop', name=self._name)
         log.info("Instance stopped")
 
-    def terminate(self):
-        jails = self.master.ezjail_admin('list')
+    @operation('terminate')
+    def terminate(self, jails=None):
         status = self._status(jails)
         if self.config.get('no-terminate', False):
             log.error("Instance '%s' is configured not to be terminated.", self.id)
@@ -342,51 +771,278 @@ class Instance(PlainInstance, StartupScriptMixin):
             self.master.ezjail_admin('stop', name=self._name)
         if status != 'stopped':
             log.info('Waiting for jail to stop')
-            while status != 'stopped':
-                jails = self.master.ezjail_admin('list')
-                status = self._status(jails)
-                sys.stdout.write('.')
-                sys.stdout.flush()
-                time.sleep(1)
-            print
+            try:
+                self.master.wait_for_jail(self._name, 'stopped')
+            except EzjailError as e:
+                log.error(e.args[0])
+                sys.exit(1)
         log.info("Terminating instance '%s'", self.id)
         self.master.ezjail_admin('delete', name=self._name)
         log.info("Instance terminated")
 
 
+class Jail(object):
+    """A jail as listed by ``ezjail-admin list``.
+
+    Item access is supported for compatibility with the dictionaries
+    which were used before. The ``config`` values of the jail are only
+    known when the jails are read with the inventory agent, otherwise
+    it is ``None``. They aren't used for comparisons."""
+
+    __slots__ = ('status', 'jid', 'ips', 'name', 'root', 'config')
+    _fields = ('status', 'jid', 'ips', 'name', 'root')
+
+    def __init__(self, status, jid, ips, name, root, config=None):
+        self.status = status
+        self.jid = jid
+        self.ips = ips
+        self.name = name
+        self.root = root
+        self.config = config
+
+    @property
+    def ip(self):
+        return ','.join(self.ips)
+
+    @property
+    def state(self):
+        status = self.status
+        if len(status) != 2 or status[0] not in 'DIEBZ' or status[1] not in 'RAS':
+            raise EzjailError("Invalid jail status '%s' for '%s'" % (status, self.name))
+        if status[1] == 'R':
+            return 'running'
+        elif status[1] == 'S':
+            return 'stopped'
+        raise EzjailError("Don't know how to handle mounted but not running jail '%s'" % self.name)
+
+    def __getitem__(self, key):
+        if key != 'ip' and key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if not isinstance(other, Jail):
+            return NotImplemented
+        return all(getattr(self, x) == getattr(other, x) for x in self._fields)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<%s %s status=%r jid=%r ips=%r root=%r>" % (
+            self.__class__.__name__, self.name, self.status, self.jid,
+            self.ips, self.root)
+
+
+def iter_ezjail_list(lines, names=None):
+    """Yield ``Jail`` records for the lines of ``ezjail-admin list`` output
+    following the header and separator lines.
+
+    Additional addresses of a jail are listed on continuation lines, which
+    are added to the ``ips`` of the preceding jail. If ``names`` is given,
+    only jails with these names are created."""
+    if names is not None:
+        names = frozenset(names)
+    current = None
+    skipping = False
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        first = parts[0]
+        if first == 'N/A' or first[0].isdigit():
+            # continuation line with an additional address of the
+            # previous jail
+            if current is not None:
+                current.ips = current.ips + (parts[1],)
+            elif not skipping:
+                raise EzjailError("Additional address without jail in ezjail-admin list output:\n%s" % line)
+            continue
+        if len(parts) < 4:
+            raise EzjailError("Invalid line in ezjail-admin list output:\n%s" % line)
+        if current is not None:
+            yield current
+        if names is not None and parts[3] not in names:
+            current = None
+            skipping = True
+            continue
+        skipping = False
+        current = Jail(
+            first, parts[1], (parts[2],), parts[3],
+            parts[4] if len(parts) > 4 else '')
+    if current is not None:
+        yield current
+
+
+inventory_agent_version = 2
+
+
+# Prints all jails of ezjail as JSON. The configs of ezjail are sourced like
+# ezjail does itself, running jails are matched by their root with jls.
+inventory_agent_script = r"""#!/bin/sh
+# ploy_ezjail inventory agent
+conf="${1:-/usr/local/etc/ezjail}"
+running=$(jls jid path 2>/dev/null)
+mountpoints=$(zfs list -H -o mountpoint 2>/dev/null)
+mounted=$(mount -p 2>/dev/null | awk '{print $2}')
+str() {
+    printf '%s.' "$1" | awk '
+    function emit(s,    i, c) {
+        for (i = 1; i <= length(s); i++) {
+            c = substr(s, i, 1)
+            printf "%s", (c in esc) ? esc[c] : c
+        }
+    }
+    BEGIN {
+        for (i = 1; i < 32; i++)
+            esc[sprintf("%c", i)] = sprintf("\\u%04x", i)
+        esc["\t"] = "\\t"
+        esc["\r"] = "\\r"
+        esc["\\"] = "\\\\"
+        esc["\""] = "\\\""
+        printf "\""
+    }
+    NR > 1 { emit(prev); printf "\\n" }
+    { prev = $0 }
+    END { emit(substr(prev, 1, length(prev) - 1)); printf "\"" }'
+}
+printf '{"version": 2, "jails": ['
+sep=
+for f in "$conf"/*; do
+    [ -f "$f" ] || continue
+    printf '%s' "$sep"
+    sep=', '
+    (
+    n=${f##*/}
+    n=${n%.norun}
+    . "$f"
+    eval "host=\$jail_${n}_hostname ip=\$jail_${n}_ip"
+    eval "root=\$jail_${n}_rootdir image=\$jail_${n}_image"
+    root=${root%/}
+    jid=$(printf '%s\n' "$running" | while read j p; do
+        [ "$p" = "$root" ] && echo "$j" && break
+    done)
+    if [ -n "$image" ]; then
+        status=I
+    elif printf '%s\n' "$mountpoints" | grep -qxF "$root"; then
+        status=Z
+    else
+        status=D
+    fi
+    if [ -n "$jid" ]; then
+        status=${status}R
+    elif [ -n "$image" ] && printf '%s\n' "$mounted" | grep -qxF "$root"; then
+        status=${status}A
+        jid=N/A
+    else
+        status=${status}S
+        jid=N/A
+    fi
+    printf '{"name": %s, "status": %s, "jid": %s, "root": %s, "ips": [' \
+        "$(str "${host:-$n}")" "$(str "$status")" "$(str "$jid")" "$(str "$root")"
+    s=
+    IFS=,
+    for a in $ip; do
+        printf '%s%s' "$s" "$(str "${a##*|}")"
+        s=', '
+    done
+    unset IFS
+    printf '], "config": {'
+    s=
+    for k in $(sed -n "s/^export jail_${n}_\([a-zA-Z0-9_]*\)=.*/\1/p" "$f"); do
+        eval "v=\$jail_${n}_$k"
+        printf '%s%s: %s' "$s" "$(str "$k")" "$(str "$v")"
+        s=', '
+    done
+    printf '}}'
+    )
+done
+printf ']}\n'
+"""
+
+
+inventory_agent_header = '# ploy_ezjail inventory agent'
+
+
+# Tells whether the file at the agent path is missing, an agent installed
+# by ploy_ezjail or some other file which must not be replaced.
+inventory_agent_check_script = """if [ ! -e "$0" ]; then
+    echo missing
+elif head -n 2 "$0" | grep -qxF "$1"; then
+    echo agent
+else
+    echo other
+fi
+"""
+
+
+def parse_inventory(out):
+    """Return a dict mapping jail names to ``Jail`` records from the JSON
+    output of the inventory agent.
+
+    Raises ``ValueError`` if the output isn't from a compatible agent."""
+    data = json.loads(out.decode('utf-8'))
+    if not isinstance(data, dict) or data.get('version') != inventory_agent_version:
+        raise ValueError("Unknown inventory agent version")
+    jails = {}
+    for entry in data['jails']:
+        jail = Jail(
+            entry['status'], entry['jid'], tuple(entry['ips']),
+            entry['name'], entry['root'], entry.get('config', {}))
+        jails[jail.name] = jail
+    return jails
+
+
+def parse_list_headers(header, separator):
+    """Return the field names for the columns of ``ezjail-admin list``.
+
+    The column boundaries are taken from the dashes in the separator line."""
+    headers = []
+    current = ""
+    for i, c in enumerate(separator):
+        if c != '-' or i >= len(header):
+            headers.append(current.strip())
+            if i >= len(header):
+                break
+            current = ""
+        else:
+            current = current + header[i]
+    if headers != ['STA', 'JID', 'IP', 'Hostname', 'Root Directory']:
+        raise EzjailError("ezjail-admin list output has unknown headers:\n%s" % headers)
+    return ('status', 'jid', 'ip', 'name', 'root')
+
+
+zfs_reference_regexp = re.compile(r'^zfs\[([^\]]+)\]$')
+
+
+def zfs_references(template):
+    """Return the names of the ZFS sections whose mountpoint is used by
+    the format string ``template`` as ``{zfs[name]}``."""
+    names = set()
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        match = zfs_reference_regexp.match(field or '')
+        if match is not None:
+            names.add(match.group(1))
+    return names
+
+
 class ZFS_FS(object):
     def __init__(self, zfs, name, config):
         self._name = name
         self.zfs = zfs
         self.config = config
-        mp_args = (
-            "zfs", "get", "-Hp", "-o", "property,value",
-            "mountpoint", self['path'])
-        rc, rout, rerr = self.zfs.master._exec(*mp_args)
-        if rc != 0 and self.config.get('create', False):
-            args = ['zfs', 'create']
-            for k, v in self.config.items():
-                if not k.startswith('set-'):
-                    continue
-                args.append("-o '%s=%s'" % (k[4:], v))
-            args.append(self['path'])
-            rc, out, err = self.zfs.master._exec(*args)
-            if rc != 0:
-                log.error(
-                    "Couldn't create zfs filesystem '%s' at '%s'." % (
-                        self._name, self['path']))
-                log.error(err)
-                sys.exit(1)
-        rc, out, err = self.zfs.master._exec(*mp_args)
-        if rc == 0:
-            info = out.strip().split(b'\t')
-            assert info[0] == b'mountpoint'
-            self.mountpoint = info[1].decode('ascii')
-            return
-        log.error(
-            "Trying to use non existing zfs filesystem '%s' at '%s'." % (
-                self._name, self['path']))
-        sys.exit(1)
+        self._mountpoint = None
 
     def __getitem__(self, key):
         value = self.config[key]
@@ -394,23 +1050,183 @@ class ZFS_FS(object):
             return value.format(zfs=self.zfs)
         return value
 
+    @property
+    def mountpoint(self):
+        self.zfs.resolve([self._name])
+        if self._mountpoint is None:
+            log.error(
+                "Trying to use non existing zfs filesystem '%s' at '%s'." % (
+                    self._name, self['path']))
+            sys.exit(1)
+        return self._mountpoint
+
     def __str__(self):
         return self.mountpoint
 
 
+def parse_zfs_list(out):
+    mountpoints = {}
+    for line in out.splitlines():
+        info = line.split(b'\t')
+        if len(info) != 2:
+            continue
+        mountpoints[info[0].decode('utf-8')] = info[1].decode('utf-8')
+    return mountpoints
+
+
 class ZFS(object):
     def __init__(self, master):
         self.master = master
         self.config = self.master.main_config.get('ez-zfs', {})
         self._cache = {}
+        self._resolved = set()
+        # bulk workers share the master and may resolve at the same time
+        self._lock = threading.Lock()
+
+    @lazy
+    def cache_path(self):
+        return os.path.join(
+            self.master.main_config.path,
+            'ezjail-zfs-%s.json' % self.master.id)
+
+    def _load_cache(self):
+        ttl = self.master.zfs_cache_ttl
+        if ttl <= 0:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+            age = time.time() - data['timestamp']
+            data['mountpoints'].items()
+        except (AttributeError, IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if age < 0 or age >= ttl:
+            return None
+        return data
+
+    def _read_cache(self, paths):
+        data = self._load_cache()
+        if data is None:
+            return None
+        mountpoints = data['mountpoints']
+        if not all(x in mountpoints for x in paths):
+            return None
+        return mountpoints
+
+    def _write_cache(self, mountpoints):
+        if self.master.zfs_cache_ttl <= 0:
+            return
+        data = self._load_cache()
+        if data is None:
+            data = dict(timestamp=time.time(), mountpoints={})
+        # still valid entries of other filesystems are kept, they all
+        # expire with the oldest one
+        data['mountpoints'].update(mountpoints)
+        tmp_path = '%s.%s' % (self.cache_path, random_token())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            log.warning(
+                "Couldn't write zfs cache '%s': %s" % (self.cache_path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def invalidate(self):
+        """Forget the resolved mountpoints and remove the cache file, so
+        they are looked up on the host again on next use."""
+        with self._lock:
+            self._resolved = set()
+            for fs in self._cache.values():
+                fs._mountpoint = None
+            if os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
 
     def __getitem__(self, key):
         if key not in self._cache:
             self._cache[key] = ZFS_FS(self, key, self.config[key])
         return self._cache[key]
 
+    def _list_args(self, paths):
+        return ('zfs', 'list', '-H', '-o', 'name,mountpoint') + tuple(paths)
+
+    def resolve(self, names=None):
+        """Look up the mountpoints of the filesystems ``names`` with one
+        ``zfs list`` call and create the missing ones which have ``create``
+        set with one more call. Without ``names`` all configured filesystems
+        are resolved.
+
+        Filesystems which are resolved already are skipped."""
+        if names is None:
+            names = self.config
+        names = set(names) - self._resolved
+        if not names:
+            return
+        with self._lock:
+            names = names - self._resolved
+            if not names:
+                return
+            self._resolve([self[x] for x in sorted(names)])
+            self._resolved.update(names)
+
+    def _resolve(self, filesystems):
+        paths = sorted(set(fs['path'] for fs in filesystems))
+        mountpoints = self._read_cache(paths)
+        if mountpoints is not None:
+            for fs in filesystems:
+                fs._mountpoint = mountpoints[fs['path']]
+            return
+        rc, out, err = self.master._exec(*self._list_args(paths))
+        # missing filesystems make zfs exit with an error, but the existing
+        # ones are still listed
+        mountpoints = parse_zfs_list(out)
+        missing = []
+        for fs in filesystems:
+            path = fs['path']
+            if path in mountpoints or path in missing:
+                continue
+            if fs.config.get('create', False):
+                missing.append(path)
+        if missing:
+            missing.sort()
+            steps = RemoteSteps()
+            for path in missing:
+                fs = [x for x in filesystems if x['path'] == path][0]
+                args = ['zfs', 'create']
+                for k, v in sorted(fs.config.items()):
+                    if not k.startswith('set-'):
+                        continue
+                    args.extend(['-o', '%s=%s' % (k[4:], v)])
+                args.append(path)
+                steps.add(
+                    args,
+                    error="Couldn't create zfs filesystem '%s' at '%s'." % (
+                        fs._name, path))
+            steps.add(self._list_args(missing))
+            try:
+                results = steps.run(self.master, batched=True)
+            except EzjailError as e:
+                log.error("Couldn't create zfs filesystems: %s" % e)
+                sys.exit(1)
+            for result in results:
+                if result.rc != 0 and result.step.error:
+                    log.error(result.step.error)
+                    log.error(result.err.decode('utf-8', 'replace'))
+                    sys.exit(1)
+            if len(results) == len(steps):
+                mountpoints.update(parse_zfs_list(results[-1].out))
+        for fs in filesystems:
+            fs._mountpoint = mountpoints.get(fs['path'])
+        self._write_cache(mountpoints)
+
 
 class EzjailProxyInstance(ProxyInstance):
+    def close_conn(self):
+        self.master.close()
+        ProxyInstance.close_conn(self)
+
+    @operation('status')
     def status(self):
         result = None
         hasstatus = hasattr(self._proxied_instance, 'status')
@@ -422,33 +1238,360 @@ class EzjailProxyInstance(ProxyInstance):
             except EzjailError as e:
                 log.error("Can't get status of jails: %s", e)
                 return result
-            unknown = set(jails)
-            for sid in sorted(self.master.instances):
-                if sid == self.id:
-                    continue
-                instance = self.master.instances[sid]
-                unknown.discard(instance._name)
-                status = instance._status(jails)
-                sip = instance.config.get('ip', '')
-                jip = jails.get(instance._name, {}).get('ip', 'unknown ip')
-                if status == 'running' and jip != sip:
-                    sip = "%s != configured %s" % (jip, sip)
-                log.info("%-20s %-15s %15s" % (sid, status, sip))
-            for sid in sorted(unknown):
-                jip = jails[sid].get('ip', 'unknown ip')
-                log.warning("Unknown jail found: %-20s %15s" % (sid, jip))
+            for entry in self.master.jail_report(jails):
+                log_jail_report_entry(entry)
+        return result
+
+
+def log_jail_report_entry(entry, prefix=''):
+    if entry['status'] == 'unknown':
+        log.warning("%sUnknown jail found: %-20s %15s" % (
+            prefix, entry['name'], entry['jail_ip']))
+        return
+    sip = entry['ip']
+    if entry['ip_mismatch']:
+        jip = entry['jail_ip'] or 'unknown ip'
+        sip = "%s != configured %s" % (jip, sip)
+    log.info("%s%-20s %-15s %15s" % (
+        prefix, entry['instance'], entry['status'], sip))
+
+
+Span = namedtuple(
+    'Span',
+    'master operation command args bytes_in bytes_out rc start seconds')
+
+
+def byte_length(data):
+    """Return the size of ``data`` in bytes, text is measured UTF-8
+    encoded like it is sent."""
+    if data is None:
+        return 0
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return len(data)
+
+
+class TimedExecutor(object):
+    """Wraps the executor of a master and passes a ``Span`` for each
+    remote command to the ``span_listeners`` of the master."""
+
+    def __init__(self, master, executor):
+        self.master = master
+        self.executor = executor
+
+    def __getattr__(self, name):
+        return getattr(self.executor, name)
+
+    def command_label(self, args):
+        if not args:
+            return ''
+        if args[0] == self.master.ezjail_admin_binary and len(args) > 1:
+            return 'ezjail-admin %s' % args[1]
+        return os.path.basename(args[0])
+
+    def __call__(self, *args, **kwargs):
+        listeners = self.master.span_listeners
+        if not listeners:
+            return self.executor(*args, **kwargs)
+        start = time.time()
+        begin = monotonic()
+        rc = out = err = None
+        try:
+            rc, out, err = self.executor(*args, **kwargs)
+            return rc, out, err
+        finally:
+            stdin = kwargs.get('stdin')
+            span = Span(
+                master=self.master.id,
+                operation=current_operation(),
+                command=self.command_label(args),
+                args=args[1:],
+                bytes_in=byte_length(stdin),
+                bytes_out=byte_length(out) + byte_length(err),
+                rc=rc,
+                start=start,
+                seconds=monotonic() - begin)
+            for listener in listeners:
+                listener(span)
+
+
+class Timings(object):
+    """Collects spans and summarizes them per operation and command."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def __call__(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def summary(self):
+        rows = OrderedDict()
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            key = (span.operation or '-', span.command)
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = dict(
+                    operation=key[0], command=key[1], count=0, seconds=0.0,
+                    max_seconds=0.0, bytes_in=0, bytes_out=0)
+            row['count'] += 1
+            row['seconds'] += span.seconds
+            row['max_seconds'] = max(row['max_seconds'], span.seconds)
+            row['bytes_in'] += span.bytes_in
+            row['bytes_out'] += span.bytes_out
+        return sorted(rows.values(), key=lambda x: -x['seconds'])
+
+    def log_summary(self, title):
+        rows = self.summary()
+        if not rows:
+            return
+        log.info("Remote commands of %s:", title)
+        log.info("%-12s %-24s %5s %9s %9s %9s %9s" % (
+            'operation', 'command', 'count', 'total', 'max', 'in', 'out'))
+        for row in rows:
+            log.info("%-12s %-24s %5d %8.3fs %8.3fs %9d %9d" % (
+                row['operation'], row['command'], row['count'],
+                row['seconds'], row['max_seconds'],
+                row['bytes_in'], row['bytes_out']))
+
+
+class CallCounter(object):
+    """Counts the remote commands of one or more masters per operation.
+
+    Use it as a context manager around the code to measure. If ``limit``
+    is set, an ``AssertionError`` is raised on exit when more commands
+    were run, which makes it usable as a call budget in tests::
+
+        with CallCounter(master, limit=5):
+            instance.start()
+    """
+
+    def __init__(self, masters, limit=None):
+        if isinstance(masters, Master):
+            masters = [masters]
+        self.masters = list(masters)
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def __call__(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def __enter__(self):
+        for master in self.masters:
+            master.span_listeners.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for master in self.masters:
+            master.span_listeners.remove(self)
+        if exc_type is None and self.limit is not None and self.total > self.limit:
+            raise AssertionError(
+                "%d remote commands exceed the budget of %d:\n%s" % (
+                    self.total, self.limit, "\n".join(
+                        "%s %s %s" % (x.master, x.operation, x.command)
+                        for x in self.spans)))
+
+    @property
+    def total(self):
+        return len(self.spans)
+
+    @property
+    def counts(self):
+        """Number of commands per operation, ``None`` for commands run
+        outside of an operation."""
+        counts = OrderedDict()
+        for span in self.spans:
+            counts[span.operation] = counts.get(span.operation, 0) + 1
+        return counts
+
+
+class SpanLog(object):
+    """Appends spans as JSON lines to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span._asdict(), sort_keys=True)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class ShellSession(object):
+    """A shell running on the host which executes one command at a time.
+
+    Each command writes its output to temporary files on the host. Exit
+    code and sizes are then sent back in a header line followed by the
+    contents, so stdout and stderr can be read exactly without any
+    markers inside the data."""
+
+    def __init__(self, stdin, stdout, close=None):
+        self.stdin = stdin
+        self.stdout = stdout
+        self._close = close
+        self.marker = 'PLOY-%s' % random_token()
+        self._write('\n'.join([
+            'ploy_out=$(mktemp "${TMPDIR:-/tmp}/ploy_ezjail.XXXXXX") || exit 1',
+            'ploy_err=$(mktemp "${TMPDIR:-/tmp}/ploy_ezjail.XXXXXX") || exit 1',
+            "trap 'rm -f \"$ploy_out\" \"$ploy_err\"' EXIT",
+            # the stderr of the commands is captured in files, nothing
+            # else of the shell may end up between the responses
+            'exec 2>/dev/null',
+            '']))
+
+    def _write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.stdin.write(data)
+        self.stdin.flush()
+
+    def _read(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.stdout.read(size)
+            if not chunk:
+                raise EzjailError("Shell on host closed unexpectedly.")
+            chunks.append(chunk)
+            size = size - len(chunk)
+        return b''.join(chunks)
+
+    def script(self, args, stdin=None):
+        cmd = shjoin(args)
+        lines = []
+        if stdin is None:
+            lines.append('%s </dev/null >"$ploy_out" 2>"$ploy_err"' % cmd)
+        else:
+            lines.append("{ %s <<'%s' | %s >\"$ploy_out\"; } 2>\"$ploy_err\"" % (
+                shjoin(b64decode_args), self.marker, cmd))
+            lines.extend(b64lines(stdin))
+            lines.append(self.marker)
+        lines.extend([
+            'ploy_rc=$?',
+            'ploy_outlen=$(wc -c <"$ploy_out")',
+            'ploy_errlen=$(wc -c <"$ploy_err")',
+            'echo "%s $ploy_rc $((ploy_outlen)) $((ploy_errlen))"' % self.marker,
+            'cat "$ploy_out" "$ploy_err"',
+            ''])
+        return '\n'.join(lines)
+
+    def _read_header(self):
+        # output which isn't from a command, like warnings of sudo on the
+        # combined stderr of the channel, can only come before the header
+        while True:
+            line = self.stdout.readline()
+            if not line:
+                raise EzjailError("Shell on host closed unexpectedly.")
+            if line.startswith(self.marker.encode('ascii')):
+                return line.decode('ascii', 'replace').split()
+            log.debug("Unexpected output from shell on host: %r", line)
+
+    def run(self, args, stdin=None):
+        self._write(self.script(args, stdin=stdin))
+        header = self._read_header()
+        if len(header) != 4 or header[0] != self.marker:
+            raise EzjailError("Unexpected output from shell on host: %r" % ' '.join(header))
+        rc, outlen, errlen = (int(x) for x in header[1:])
+        out = self._read(outlen)
+        err = self._read(errlen)
+        return (rc, out, err)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+
+class ShellExecutor(object):
+    """Executes commands through long lived shells on the host of an
+    instance instead of opening a new ssh channel for each command.
+
+    Idle shells are kept in a pool, so concurrent callers each get their
+    own shell."""
+
+    def __init__(self, instance, prefix_args=()):
+        self.instance = instance
+        self.prefix_args = tuple(prefix_args)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _open_session(self):
+        log.debug('Opening shell on instance %s', self.instance.uid)
+        chan = self.instance.conn.get_transport().open_session()
+        # stderr is never read separately, so it can't fill the window of
+        # the channel and stall the session
+        chan.set_combine_stderr(True)
+        chan.exec_command(shjoin(self.prefix_args + ('sh',)))
+        return ShellSession(
+            chan.makefile('wb', -1), chan.makefile('rb', -1), close=chan.close)
+
+    def __call__(self, *cmd_args, **kw):
+        stdin = kw.pop('stdin', None)
+        with self._lock:
+            session = self._idle.pop() if self._idle else None
+        if session is None:
+            session = self._open_session()
+        log.debug('Executing on instance %s:\n%s', self.instance.uid, shjoin(cmd_args))
+        try:
+            result = session.run(cmd_args, stdin=stdin)
+        except Exception:
+            session.close()
+            raise
+        with self._lock:
+            self._idle.append(session)
         return result
 
+    def close(self):
+        with self._lock:
+            sessions = self._idle
+            self._idle = []
+        for session in sessions:
+            session.close()
+
+
+def instance_sections(main_config, sectiongroupname='ez-instance'):
+    """Return a dict mapping master ids to the ids of the
+    ``sectiongroupname`` sections which belong to them. The ids of sections
+    without a ``master`` option are stored with ``None`` as key, they belong
+    to all masters."""
+    result = {}
+    for sid, config in main_config.get(sectiongroupname, {}).items():
+        masters = config.get('master')
+        if masters is None:
+            result.setdefault(None, []).append(sid)
+            continue
+        for master in masters.split():
+            result.setdefault(master, []).append(sid)
+    return result
+
 
 class Master(BaseMaster):
     sectiongroupname = 'ez-instance'
     instance_class = Instance
-    _exec = None
+    # the ez-instance sections are added by ``_add_instances``
+    section_info = {None: Instance}
 
-    def __init__(self, *args, **kwargs):
-        BaseMaster.__init__(self, *args, **kwargs)
+    def __init__(self, ctrl, mid, master_config, sections=None):
+        BaseMaster.__init__(self, ctrl, mid, master_config)
+        self._add_instances(sections)
         self.debug = self.master_config.get('debug-commands', False)
         self.use_one_prefix = self.master_config.get('ezjail-use-one-prefix', False)
+        self.batch_provisioning = self.master_config.get('ezjail-batch-provisioning', False)
+        self.jails_cache_ttl = self.master_config.get('ezjail-list-cache-ttl', 5)
+        self.bulk_workers = self.master_config.get('ezjail-bulk-workers', 8)
+        self.wait_timeout = self.master_config.get('ezjail-wait-timeout', 60)
+        self.zfs_cache_ttl = self.master_config.get('ezjail-zfs-cache-ttl', 0)
+        self.jail_zfs = self.master_config.get('ezjail-jailzfs')
+        self.inventory_agent = self.master_config.get('ezjail-inventory-agent')
+        self._agent_checked = False
+        self._jails_cache = None
+        self._list_headers = {}
+        self._fingerprints = {}
         if 'instance' not in self.master_config:
             instance = PlainInstance(self, self.id, self.master_config)
         else:
@@ -459,12 +1602,56 @@ class Master(BaseMaster):
             self.instances[self.id] = self.instance
         else:
             self.instance = None
+        self.span_listeners = []
+        self.timings = None
+        if self.master_config.get('ezjail-timing-summary', False):
+            self.timings = Timings()
+            self.span_listeners.append(self.timings)
+            atexit.register(
+                self.timings.log_summary, "ez-master '%s'" % self.id)
+        if self.master_config.get('ezjail-timing-log'):
+            self.span_listeners.append(
+                SpanLog(self.master_config['ezjail-timing-log']))
+
+    def _add_instances(self, sections=None):
+        """Add the ``ez-instance`` sections of this master like
+        ``BaseMaster`` does, but look them up in ``sections`` as returned by
+        ``instance_sections`` instead of checking all sections for each
+        master."""
+        if sections is None:
+            sections = instance_sections(self.main_config, self.sectiongroupname)
+        sids = set(sections.get(self.id, ()))
+        sids.update(sections.get(None, ()))
+        if not sids:
+            return
+        group = self.main_config[self.sectiongroupname]
+        for sid in [x for x in group if x in sids]:
+            group[sid] = group[sid].copy()
+            self.instances[sid] = self.instance_class(self, sid, group[sid])
+            self.instances[sid].sectiongroupname = self.sectiongroupname
+
+    @lazy
+    def _exec(self):
+        """The executor for commands on the host, only created when the
+        first command is run."""
         prefix_args = ()
         if self.master_config.get('sudo'):
             prefix_args = ('sudo',)
-        if self._exec is None:
-            self._exec = InstanceExecutor(
+        if self.instance is not None and self.master_config.get('ezjail-persistent-shell', False):
+            executor = ShellExecutor(
+                instance=self.instance, prefix_args=prefix_args)
+        else:
+            executor = InstanceExecutor(
                 instance=self.instance, prefix_args=prefix_args)
+        return TimedExecutor(self, executor)
+
+    def close(self):
+        """Close the shells of the ``ezjail-persistent-shell`` executor,
+        if it was used."""
+        executor = self.__dict__.get('_exec')
+        close = getattr(executor, 'close', None)
+        if close is not None:
+            close()
 
     @lazy
     def zfs(self):
@@ -485,33 +1672,398 @@ class Master(BaseMaster):
         except socket.error as e:
             raise EzjailError("Couldn't connect to instance [%s]:\n%s" % (self.instance.config_id, e))
 
-    @lazy
-    def ezjail_admin_list_headers(self):
-        rc, out, err = self._ezjail_admin('list')
-        if rc:
+    def _create_args(self, name, ip, flavour=None, clone=None):
+        """Return the command to create a jail, either with
+        ``ezjail-admin create`` or by cloning the ZFS snapshot ``clone``
+        and registering the clone with ezjail."""
+        if clone is not None:
+            if not self.jail_zfs:
+                raise EzjailError(
+                    "The 'ezjail-jailzfs' option of master '%s' is needed to clone jails." % self.id)
+            return (
+                'sh', '-c', clone_jail_script, clone,
+                '%s/%s' % (self.jail_zfs, name),
+                self.ezjail_admin_binary, name, ip)
+        args = [self.ezjail_admin_binary, 'create', '-c', 'zfs']
+        if flavour is not None:
+            args.extend(['-f', flavour])
+        args.extend([name, ip])
+        return tuple(args)
+
+    bulk_commands = ('create', 'start', 'stop', 'terminate')
+
+    def run_command(self, command, instance, jails=None, overrides=None):
+        """Run one of the ``bulk_commands`` for ``instance`` including the
+        before and after hooks of ploy."""
+        if command not in self.bulk_commands:
+            raise ValueError("Unknown command '%s'" % command)
+        kwargs = dict(jails=jails)
+        if command in ('create', 'start', 'stop'):
+            kwargs['overrides'] = overrides
+        if command == 'start':
+            instance.hooks.before_start(instance)
+        elif command == 'terminate':
+            instance.hooks.before_terminate(instance)
+        result = getattr(instance, command)(**kwargs)
+        if command == 'start':
+            instance.hooks.after_start(instance)
+        elif command == 'terminate':
+            instance.hooks.after_terminate(instance)
+        return result
+
+    def bulk(self, command, instances, workers=None, overrides=None):
+        """Run ``command`` for several instances of this master concurrently.
+
+        The jail list is fetched once and shared by all workers. Returns an
+        ordered dict mapping instance ids to ``BulkResult`` tuples, failures
+        are recorded there instead of aborting the remaining instances."""
+        if command not in self.bulk_commands:
+            raise ValueError("Unknown command '%s'" % command)
+        instances = list(instances)
+        for instance in instances:
+            if instance.master is not self:
+                raise ValueError("Instance '%s' doesn't belong to master '%s'." % (
+                    instance.config_id, self.id))
+        if command == 'create':
+            return self.bulk_create(instances, overrides=overrides)
+        if workers is None:
+            workers = self.bulk_workers
+        jails = self.ezjail_admin('list')
+
+        def run(instance):
+            try:
+                result = self.run_command(
+                    command, instance, jails=jails, overrides=overrides)
+            except SystemExit as e:
+                return BulkResult(instance, None, "exited with code %s" % e.code)
+            except Exception as e:
+                log.exception("Error in '%s' of instance '%s'.", command, instance.config_id)
+                return BulkResult(instance, None, str(e) or e.__class__.__name__)
+            return BulkResult(instance, result, None)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(workers, len(instances))))
+        try:
+            results = pool.map(run, instances)
+        finally:
+            pool.close()
+            pool.join()
+        return OrderedDict((x.instance.id, x) for x in results)
+
+    def _validate_create(self, instances, jails):
+        """Return a dict mapping instance ids to an error message for all
+        instances which can't be created together."""
+        errors = {}
+        by_name = {}
+        by_ip = {}
+        for jail in jails.values():
+            for ip in jail.ips:
+                by_ip.setdefault(ip.split('|')[-1], []).append(jail.name)
+        for instance in instances:
+            if instance._name in jails:
+                continue
+            by_name.setdefault(instance._name, []).append(instance)
+            ip = instance.config.get('ip')
+            if not ip:
+                errors[instance.id] = "No IP address set"
+                continue
+            flavour = instance._get_flavour()
+            clone = instance._get_clone()
+            for value in (ip, flavour, clone):
+                if value is not None and len(value.split()) != 1:
+                    errors[instance.id] = "The value '%s' contains whitespace" % value
+            if clone is not None and not self.jail_zfs:
+                errors[instance.id] = "The 'ezjail-jailzfs' option of the master is needed to clone jails"
+            for ip in ip.split(','):
+                by_ip.setdefault(ip.split('|')[-1], []).append(instance._name)
+        for name, named in by_name.items():
+            if len(named) > 1:
+                for instance in named:
+                    errors[instance.id] = "Duplicate jail name '%s'" % name
+        for ip, names in by_ip.items():
+            if len(names) < 2:
+                continue
+            for instance in instances:
+                if instance._name in names and instance._name not in jails:
+                    errors.setdefault(instance.id, "IP address '%s' is used by %s" % (
+                        ip, ", ".join("'%s'" % x for x in sorted(set(names)))))
+        return errors
+
+    def bulk_create(self, instances, overrides=None):
+        """Create the jails of several instances of this master together.
+
+        All instances are validated first, then the jails are created with
+        one script, listed once and the startup scripts of all of them are
+        installed with one more script. Returns an ordered dict like
+        ``bulk``, instances which already exist get ``None`` as result."""
+        instances = list(instances)
+        results = OrderedDict()
+        jails = self.ezjail_admin('list')
+        errors = self._validate_create(instances, jails)
+        startup_scripts = {}
+        create = RemoteSteps()
+        pending = []
+        for instance in instances:
+            if instance._name in jails:
+                log.info("Instance '%s' already created", instance.id)
+                results[instance.id] = BulkResult(instance, None, None)
+                continue
+            if instance.id not in errors:
+                try:
+                    startup_scripts[instance.id] = instance.startup_script(
+                        overrides=overrides)
+                except SystemExit as e:
+                    errors[instance.id] = "Startup script failed with code %s" % e.code
+            if instance.id in errors:
+                results[instance.id] = BulkResult(instance, None, errors[instance.id])
+                continue
+            log.info("Creating instance '%s'", instance.id)
+            create.add(self._create_args(
+                instance._name, instance.config['ip'],
+                flavour=instance._get_flavour(), clone=instance._get_clone()))
+            pending.append(instance)
+        if not pending:
+            return results
+        try:
+            create_results = create.run(self, batched=True)
+        except EzjailError as e:
+            log.error("Couldn't create jails: %s", e)
+            create_results = []
+        finally:
+            self.invalidate_jails()
+        created = []
+        for instance, result in zip(pending, create_results):
+            if result.rc == 0:
+                created.append(instance)
+                continue
+            msg = result.out.strip() + b'\n' + result.err.strip()
+            results[instance.id] = BulkResult(
+                instance, None, msg.decode('utf-8', 'replace').strip())
+        for instance in pending[len(create_results):]:
+            results[instance.id] = BulkResult(instance, None, "Not created")
+        jails = self.ezjail_admin('list')
+        listed = []
+        paths = []
+        for instance in created:
+            jail = jails.get(instance._name)
+            if jail is None:
+                results[instance.id] = BulkResult(
+                    instance, None, "Jail not listed after creation")
+                continue
+            listed.append((instance, jail))
+            startup_script = startup_scripts[instance.id]
+            if instance._check_startup_hashes():
+                paths.extend(
+                    x[0] for x in instance._startup_files(jail, startup_script))
+        hashes = self.file_hashes(paths)
+        install = RemoteSteps()
+        owners = []
+        for instance, jail in listed:
+            steps = instance._startup_steps(
+                jail, startup_scripts[instance.id], hashes)
+            for args, stdin, error in steps:
+                install.add(args, stdin=stdin)
+                owners.append((instance, error))
+        try:
+            install_results = install.run(self, batched=True)
+        except EzjailError as e:
+            log.error("Couldn't install startup scripts: %s", e)
+            install_results = []
+        failed = {}
+        for (instance, error), result in zip(owners, install_results):
+            if result.rc != 0:
+                failed.setdefault(instance.id, error)
+        for instance, error in owners[len(install_results):]:
+            failed.setdefault(instance.id, error)
+        for instance in created:
+            if instance.id in results:
+                continue
+            results[instance.id] = BulkResult(
+                instance, None if instance.id in failed else True,
+                failed.get(instance.id))
+        return OrderedDict(
+            (x.id, results[x.id]) for x in instances if x.id in results)
+
+    def jail_report(self, jails):
+        """Return a list of dicts describing the state of all configured
+        instances of this master in ``jails``, followed by the jails which
+        aren't configured with status ``unknown``."""
+        report = []
+        unknown = set(jails)
+        for sid in sorted(self.instances):
+            if sid == self.id:
+                continue
+            instance = self.instances[sid]
+            unknown.discard(instance._name)
+            status = instance._status(jails)
+            sip = instance.config.get('ip', '')
+            jail = jails.get(instance._name)
+            jip = None if jail is None else jail.ip
+            report.append(dict(
+                instance=sid, name=instance._name, status=status,
+                ip=sip, jail_ip=jip,
+                ip_mismatch=status == 'running' and jip != sip))
+        for name in sorted(unknown):
+            report.append(dict(
+                instance=None, name=name, status='unknown',
+                ip=None, jail_ip=jails[name].ip, ip_mismatch=False))
+        return report
+
+    def file_hashes(self, paths):
+        """Return a dict with the SHA256 hex digests of the files ``paths``
+        on the host, ``None`` for missing files. All files are checked with
+        one command."""
+        paths = list(paths)
+        if not paths:
+            return {}
+        rc, out, err = self._exec('sh', '-c', file_hashes_script, 'sh', *paths)
+        lines = out.decode('ascii', 'replace').splitlines()
+        if rc != 0 or len(lines) != len(paths):
+            return dict.fromkeys(paths)
+        return dict(
+            (path, None if digest == '-' else digest)
+            for path, digest in zip(paths, lines))
+
+    def jail_running(self, name):
+        """Check whether the jail ``name`` is running by asking ``jls``
+        about this jail only."""
+        rc, out, err = self._exec('jls', '-j', ezjail_safename(name), 'jid')
+        return rc == 0
+
+    def jail_info(self, name):
+        """Return the state, jid and root directory of the jail ``name``.
+
+        The state is ``running``, ``stopped`` or ``unavailable``, the jid
+        and root are ``None`` for unavailable jails. The cached jail list
+        is used if there is one, otherwise only this jail is looked up on
+        the host with ``jls`` and the ezjail config."""
+        if self._get_cached_jails() is not None:
+            jail = self.ezjail_admin('list', names=[name]).get(name)
+            if jail is None:
+                return ('unavailable', None, None)
+            return (jail.state, jail.jid, jail.root)
+        try:
+            rc, out, err = self._exec(
+                'sh', '-c', jail_state_script, ezjail_safename(name))
+        except socket.error as e:
+            raise EzjailError("Couldn't connect to instance [%s]:\n%s" % (self.instance.config_id, e))
+        info = out.decode('utf-8').strip().split(None, 2)
+        if rc == 0 and info == ['unavailable']:
+            return ('unavailable', None, None)
+        if rc == 0 and len(info) == 3 and info[0] == 'attached':
+            # same as Jail.state for the list output
+            raise EzjailError("Don't know how to handle mounted but not running jail '%s'" % name)
+        if rc != 0 or len(info) != 3 or info[0] not in ('running', 'stopped'):
             msg = out.strip() + b'\n' + err.strip()
             raise EzjailError(msg.decode('utf-8').strip())
-        lines = out.decode('utf-8').splitlines()
-        if len(lines) < 2:
-            raise EzjailError("ezjail-admin list output too short:\n%s" % out.strip())
-        headers = []
-        current = ""
-        for i, c in enumerate(lines[1]):
-            if c != '-' or i >= len(lines[0]):
-                headers.append(current.strip())
-                if i >= len(lines[0]):
-                    break
-                current = ""
-            else:
-                current = current + lines[0][i]
-        if headers != ['STA', 'JID', 'IP', 'Hostname', 'Root Directory']:
-            raise EzjailError("ezjail-admin list output has unknown headers:\n%s" % headers)
-        return ('status', 'jid', 'ip', 'name', 'root')
+        return tuple(info)
+
+    def jail_state(self, name):
+        """Return ``running``, ``stopped`` or ``unavailable`` for the jail
+        ``name``, see ``jail_info``."""
+        return self.jail_info(name)[0]
+
+    def wait_for_jail(self, name, state, timeout=None):
+        """Wait until the jail ``name`` is ``running`` or ``stopped``.
+
+        The jail is polled with exponential backoff and an ``EzjailError``
+        is raised if it hasn't reached the state after ``timeout`` seconds,
+        which defaults to the ``ezjail-wait-timeout`` option."""
+        if state not in ('running', 'stopped'):
+            raise ValueError("Unknown jail state '%s'" % state)
+        if timeout is None:
+            timeout = self.wait_timeout
+        deadline = monotonic() + timeout
+        delay = 0.1
+        while self.jail_running(name) != (state == 'running'):
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise EzjailError("Jail '%s' not %s after %s seconds." % (name, state, timeout))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 5)
+        self.invalidate_jails()
+
+    def invalidate_jails(self):
+        """Drop the cached ``ezjail-admin list`` output, so the next
+        ``ezjail_admin('list')`` call queries the host again."""
+        self._jails_cache = None
+
+    def install_agent(self):
+        """Upload the inventory agent to the ``ezjail-inventory-agent``
+        path on the host."""
+        rc, out, err = self._exec(
+            'sh', '-c', upload_file_script, self.inventory_agent, '0755',
+            stdin=inventory_agent_script.encode('utf-8'))
+        self._agent_checked = True
+        if rc:
+            msg = out.strip() + b'\n' + err.strip()
+            raise EzjailError("Couldn't install inventory agent '%s':\n%s" % (
+                self.inventory_agent, msg.decode('utf-8', 'replace').strip()))
+
+    def _agent_replaceable(self):
+        """Return whether the file at the agent path is missing or was
+        installed by ploy_ezjail, other files are never replaced."""
+        try:
+            rc, out, err = self._exec(
+                'sh', '-c', inventory_agent_check_script,
+                self.inventory_agent, inventory_agent_header)
+        except socket.error as e:
+            raise EzjailError("Couldn't connect to instance [%s]:\n%s" % (self.instance.config_id, e))
+        return rc == 0 and out.strip() in (b'missing', b'agent')
+
+    def _query_agent(self):
+        """Return the jails reported by the inventory agent, or ``None`` if
+        they have to be read from ``ezjail-admin list`` instead.
+
+        A missing or outdated agent is installed once, the jails are listed
+        with ``ezjail-admin`` in that case. A file at the agent path which
+        wasn't installed by ploy_ezjail is left alone."""
+        try:
+            rc, out, err = self._exec(self.inventory_agent)
+        except socket.error as e:
+            raise EzjailError("Couldn't connect to instance [%s]:\n%s" % (self.instance.config_id, e))
+        if rc == 0:
+            try:
+                return parse_inventory(out)
+            except (KeyError, TypeError, ValueError) as e:
+                log.debug("Invalid output of inventory agent '%s': %s", self.inventory_agent, e)
+        else:
+            log.debug("Inventory agent '%s' failed: %s", self.inventory_agent, err.strip())
+        if self._agent_checked:
+            return None
+        if rc != 127 and not self._agent_replaceable():
+            self._agent_checked = True
+            log.warning(
+                "The inventory agent '%s' on '%s' isn't usable and wasn't installed by ploy_ezjail, using 'ezjail-admin list' instead.",
+                self.inventory_agent, self.id)
+            return None
+        log.info("Installing inventory agent '%s' on '%s'.", self.inventory_agent, self.id)
+        try:
+            self.install_agent()
+        except EzjailError as e:
+            log.warning(e.args[0])
+        return None
+
+    def _get_cached_jails(self):
+        cached = self._jails_cache
+        if cached is None:
+            return None
+        if monotonic() - cached[0] >= self.jails_cache_ttl:
+            self._jails_cache = None
+            return None
+        return cached
+
+    def _get_list_headers(self, header, separator):
+        key = (header, separator)
+        headers = self._list_headers.get(key)
+        if headers is None:
+            headers = self._list_headers[key] = parse_list_headers(header, separator)
+        return headers
 
     def ezjail_admin(self, command, **kwargs):
         # make sure there is no whitespace in the arguments
         for k, v in kwargs.items():
-            if v is None:
+            if v is None or k == 'names':
                 continue
             if command == 'console' and k == 'cmd':
                 continue
@@ -525,16 +2077,14 @@ class Master(BaseMaster):
                 kwargs['cmd'],
                 kwargs['name'])
         elif command == 'create':
-            args = [
-                'create',
-                '-c', 'zfs']
-            flavour = kwargs.get('flavour')
-            if flavour is not None:
-                args.extend(['-f', flavour])
-            args.extend([
-                kwargs['name'],
-                kwargs['ip']])
-            rc, out, err = self._ezjail_admin(*args)
+            args = self._create_args(
+                kwargs['name'], kwargs['ip'],
+                flavour=kwargs.get('flavour'), clone=kwargs.get('clone'))
+            try:
+                rc, out, err = self._exec(*args)
+            except socket.error as e:
+                raise EzjailError("Couldn't connect to instance [%s]:\n%s" % (self.instance.config_id, e))
+            self.invalidate_jails()
             if rc:
                 msg = out.strip() + b'\n' + err.strip()
                 raise EzjailError(msg.decode('utf-8').strip())
@@ -543,39 +2093,41 @@ class Master(BaseMaster):
                 'delete',
                 '-fw',
                 kwargs['name'])
+            self.invalidate_jails()
             if rc:
                 msg = out.strip() + b'\n' + err.strip()
                 raise EzjailError(msg.decode('utf-8').strip())
         elif command == 'list':
-            rc, out, err = self._ezjail_admin('list')
-            if rc:
-                msg = out.strip() + b'\n' + err.strip()
-                raise EzjailError(msg.decode('utf-8').strip())
-            lines = out.decode('utf-8').splitlines()
-            if len(lines) < 2:
-                raise EzjailError("ezjail-admin list output too short:\n%s" % out.strip())
-            headers = self.ezjail_admin_list_headers
-            padding = [''] * len(headers)
-            jails = {}
-            prev_entry = None
-            for line in lines[2:]:
-                line = line.strip()
-                if not line:
-                    continue
-                if line.startswith('N/A') or line[0].isdigit():
-                    # What if prev_entry is still None?
-                    # the code fail here and someone who finds that failure
-                    # will provide us with a patch!
-                    jails[prev_entry]['ip'] = [jails[prev_entry]['ip'], line.split()[1]]
-                else:
-                    entry = dict(zip(headers, line.split() + padding))
-                    prev_entry = entry.pop('name')
-                    jails[prev_entry] = entry
+            names = kwargs.get('names')
+            cached = self._get_cached_jails()
+            if cached is None and self.inventory_agent:
+                jails = self._query_agent()
+                if jails is not None:
+                    cached = self._jails_cache = [monotonic(), None, jails]
+            if cached is None:
+                rc, out, err = self._ezjail_admin('list')
+                if rc:
+                    msg = out.strip() + b'\n' + err.strip()
+                    raise EzjailError(msg.decode('utf-8').strip())
+                lines = out.decode('utf-8').splitlines()
+                if len(lines) < 2:
+                    raise EzjailError("ezjail-admin list output too short:\n%s" % out.strip())
+                self._get_list_headers(lines[0], lines[1])
+                cached = self._jails_cache = [monotonic(), lines[2:], None]
+            jails = cached[2]
+            if jails is None:
+                jails = dict(
+                    (x.name, x) for x in iter_ezjail_list(cached[1], names=names))
+                if names is None:
+                    cached[2] = jails
+            elif names is not None:
+                jails = dict((x, jails[x]) for x in names if x in jails)
             return jails
         elif command == 'start':
             rc, out, err = self._ezjail_admin(
                 'start',
                 kwargs['name'])
+            self.invalidate_jails()
             if rc:
                 msg = out.strip() + b'\n' + err.strip()
                 raise EzjailError(msg.decode('utf-8').strip())
@@ -583,6 +2135,7 @@ class Master(BaseMaster):
             rc, out, err = self._ezjail_admin(
                 'stop',
                 kwargs['name'])
+            self.invalidate_jails()
             if rc:
                 msg = out.strip() + b'\n' + err.strip()
                 raise EzjailError(msg.decode('utf-8').strip())
@@ -591,8 +2144,26 @@ class Master(BaseMaster):
 
 
 class MountsMassager(BaseMassager):
+    """Parses the ``mounts`` option into a tuple of dicts.
+
+    The parsed option is cached by section group, key and text, at most
+    ``_parsed_limit`` entries are kept. Every call returns new dicts, so
+    callers can't change the cached ones."""
+    _parsed = {}
+    _parsed_limit = 256
+
     def __call__(self, config, sectionname):
         value = BaseMassager.__call__(self, config, sectionname)
+        cache_key = (self.sectiongroupname, self.key, value)
+        mounts = self._parsed.get(cache_key)
+        if mounts is None:
+            mounts = self.parse(value, sectionname)
+            if len(self._parsed) >= self._parsed_limit:
+                self._parsed.clear()
+            self._parsed[cache_key] = mounts
+        return tuple(OrderedDict(x) for x in mounts)
+
+    def parse(self, value, sectionname):
         mounts = []
         for line in value.splitlines():
             mount_options = line.split()
@@ -622,7 +2193,17 @@ def get_common_massagers():
     return [(x.__class__, x.key) for x in plain_massagers()]
 
 
+_instance_massagers = {}
+
+
 def get_instance_massagers(sectiongroupname='instance'):
+    """Return the massagers for instances in ``sectiongroupname``.
+
+    They are created once per section group, as this is called for every
+    instance."""
+    if sectiongroupname in _instance_massagers:
+        return list(_instance_massagers[sectiongroupname])
+
     from ploy.config import BooleanMassager
     from ploy.config import StartupScriptMassager
 
@@ -634,11 +2215,13 @@ def get_instance_massagers(sectiongroupname='instance'):
         MountsMassager(sectiongroupname, 'mounts'),
         BooleanMassager(sectiongroupname, 'no-terminate'),
         StartupScriptMassager(sectiongroupname, 'startup_script')])
-    return massagers
+    _instance_massagers[sectiongroupname] = massagers
+    return list(massagers)
 
 
 def get_massagers():
     from ploy.config import BooleanMassager
+    from ploy.config import IntegerMassager
 
     massagers = []
 
@@ -650,7 +2233,15 @@ def get_massagers():
         massagers.append(klass(sectiongroupname, name))
     massagers.extend([
         BooleanMassager(sectiongroupname, 'sudo'),
-        BooleanMassager(sectiongroupname, 'debug-commands')])
+        BooleanMassager(sectiongroupname, 'debug-commands'),
+        BooleanMassager(sectiongroupname, 'ezjail-batch-provisioning'),
+        BooleanMassager(sectiongroupname, 'ezjail-persistent-shell'),
+        IntegerMassager(sectiongroupname, 'ezjail-bulk-workers'),
+        IntegerMassager(sectiongroupname, 'ezjail-list-cache-ttl'),
+        IntegerMassager(sectiongroupname, 'ezjail-wait-timeout'),
+        IntegerMassager(sectiongroupname, 'ezjail-zfs-cache-ttl'),
+        BooleanMassager(sectiongroupname, 'ezjail-timing-summary'),
+        PathMassager(sectiongroupname, 'ezjail-timing-log')])
 
     sectiongroupname = 'ez-zfs'
     massagers.extend([
@@ -661,10 +2252,196 @@ def get_massagers():
 
 def get_masters(ploy):
     masters = ploy.config.get('ez-master', {})
+    if not masters:
+        return
+    sections = instance_sections(ploy.config)
     for master, master_config in masters.items():
-        yield Master(ploy, master, master_config)
+        yield Master(ploy, master, master_config, sections=sections)
+
+
+def fleet_status(masters, timeout=None):
+    """Get the ``jail_report`` of all ``masters`` concurrently.
+
+    Returns an ordered dict mapping master ids to dicts with the ``jails``
+    report, or an ``error`` message if the master failed or didn't answer
+    within ``timeout`` seconds. Masters which time out don't hold up the
+    others, once one timed out the pool is terminated instead of waiting
+    for its threads."""
+    masters = list(masters)
+    result = OrderedDict()
+    if not masters:
+        return result
+
+    @operation('status')
+    def run(master):
+        return master.jail_report(master.ezjail_admin('list'))
+
+    from multiprocessing import TimeoutError
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(len(masters))
+    timed_out = False
+    try:
+        pending = [(x, pool.apply_async(run, (x,))) for x in masters]
+        deadline = None if timeout is None else monotonic() + timeout
+        for master, async_result in pending:
+            entry = dict(jails=None, error=None)
+            try:
+                if deadline is None:
+                    entry['jails'] = async_result.get()
+                else:
+                    entry['jails'] = async_result.get(
+                        max(0, deadline - monotonic()))
+            except TimeoutError:
+                timed_out = True
+                entry['error'] = "timed out after %s seconds" % timeout
+            except SystemExit as e:
+                entry['error'] = "exited with code %s" % e.code
+            except Exception as e:
+                entry['error'] = str(e) or e.__class__.__name__
+            result[master.id] = entry
+    finally:
+        if timed_out:
+            pool.terminate()
+        else:
+            pool.close()
+            pool.join()
+    return result
+
+
+class StatusCmd(object):
+    """Show the status of the jails on all or some ez-masters"""
+
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        parser = argparse.ArgumentParser(
+            prog="%s ez-status" % self.ctrl.progname,
+            description=help)
+        masters = dict(
+            (k, v) for k, v in self.ctrl.masters.items()
+            if isinstance(v, Master))
+        parser.add_argument(
+            "masters", nargs="*", metavar="master",
+            help="Name of the master from the config, defaults to all.")
+        parser.add_argument(
+            "-t", "--timeout", type=float, default=30,
+            help="Seconds to wait for each master, defaults to 30.")
+        parser.add_argument(
+            "--json", action="store_true",
+            help="Print the report as JSON.")
+        args = parser.parse_args(argv)
+        for name in args.masters:
+            if name not in masters:
+                parser.error("invalid master: '%s'" % name)
+        selected = [masters[x] for x in (args.masters or sorted(masters))]
+        report = fleet_status(selected, timeout=args.timeout)
+        failed = [k for k, v in report.items() if v['error'] is not None]
+        if args.json:
+            sys.stdout.write(json.dumps(report, indent=2) + '\n')
+        else:
+            counts = OrderedDict(
+                (x, 0) for x in ('running', 'stopped', 'unavailable', 'unknown'))
+            mismatches = 0
+            for master_id, entry in report.items():
+                if entry['error'] is not None:
+                    log.error("%s: %s", master_id, entry['error'])
+                    continue
+                log.info("%s:", master_id)
+                for jail in entry['jails']:
+                    log_jail_report_entry(jail, prefix='    ')
+                    counts[jail['status']] += 1
+                    mismatches += jail['ip_mismatch']
+            log.info("%s, %d ip mismatches, %d of %d masters failed" % (
+                ", ".join("%d %s" % (v, k) for k, v in counts.items()),
+                mismatches, len(failed), len(report)))
+        if failed:
+            sys.exit(1)
+
+
+class BulkCmd(object):
+    """Create, start, stop or terminate many ezjail instances concurrently"""
+
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+
+    def __call__(self, argv, help):
+        from ploy.common import yesno
+        parser = argparse.ArgumentParser(
+            prog="%s ez-bulk" % self.ctrl.progname,
+            description=help)
+        instances = dict(
+            (k, v) for k, v in self.ctrl.instances.items()
+            if isinstance(v, Instance))
+        masters = dict(
+            (k, v) for k, v in self.ctrl.masters.items()
+            if isinstance(v, Master))
+        parser.add_argument(
+            "command", metavar="command",
+            help="The command to run for each instance.",
+            choices=Master.bulk_commands)
+        parser.add_argument(
+            "instances", nargs="*", metavar="instance",
+            help="Name of the instance from the config.")
+        parser.add_argument(
+            "-m", "--master", dest="masters", action="append", default=[],
+            metavar="master", choices=sorted_choices(masters),
+            help="Use all instances of this master.")
+        parser.add_argument(
+            "-w", "--workers", type=int, default=None,
+            help="Number of instances handled concurrently per master.")
+        parser.add_argument(
+            "-y", "--yes", action="store_true",
+            help="Don't ask for confirmation before terminating.")
+        args = parser.parse_args(argv)
+        selected = OrderedDict()
+        for master_id in args.masters:
+            master = masters[master_id]
+            for sid in sorted(master.instances):
+                instance = master.instances[sid]
+                if isinstance(instance, Instance):
+                    selected[instance.uid] = instance
+        for name in args.instances:
+            if name not in instances:
+                parser.error("invalid instance: '%s'" % name)
+            selected[instances[name].uid] = instances[name]
+        if not selected:
+            parser.error("No instances selected.")
+        if args.command == 'terminate' and not args.yes:
+            if not yesno("Are you sure you want to terminate %s?" % ", ".join(
+                    "'%s'" % x.config_id for x in selected.values())):
+                return
+        by_master = OrderedDict()
+        for instance in selected.values():
+            by_master.setdefault(instance.master, []).append(instance)
+        overrides = dict(instances=self.ctrl.instances)
+        failed = []
+        for master, master_instances in by_master.items():
+            try:
+                results = master.bulk(
+                    args.command, master_instances,
+                    workers=args.workers, overrides=overrides)
+            except EzjailError as e:
+                log.error("Can't get status of jails on '%s': %s", master.id, e)
+                failed.extend(x.uid for x in master_instances)
+                continue
+            for result in results.values():
+                if result.error is None:
+                    log.info("%-30s %s: ok", result.instance.uid, args.command)
+                else:
+                    log.error("%-30s %s: %s", result.instance.uid, args.command, result.error)
+                    failed.append(result.instance.uid)
+        if failed:
+            sys.exit(1)
+
+
+def get_commands(ctrl):
+    return [
+        ('ez-bulk', BulkCmd(ctrl)),
+        ('ez-status', StatusCmd(ctrl))]
 
 
 plugin = dict(
+    get_commands=get_commands,
     get_massagers=get_massagers,
     get_masters=get_masters)
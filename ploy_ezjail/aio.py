@@ -0,0 +1,105 @@
+"""Asyncio interface for ez-masters and their instances.
+
+ploy talks to the hosts with paramiko, which is blocking. The methods here
+run the synchronous API in an executor and return awaitables, so many
+masters and instances can be driven concurrently from one event loop::
+
+    from ploy_ezjail.aio import get_masters
+    import asyncio
+
+    async def fleet_status(ctrl):
+        masters = get_masters(ctrl)
+        states = await asyncio.gather(
+            *[x.ezjail_admin('list') for x in masters.values()])
+        return dict(zip(masters, states))
+
+The methods must be called while an event loop is running.
+"""
+from __future__ import unicode_literals
+from ploy_ezjail import Master
+import asyncio
+import functools
+
+
+class AsyncMaster(object):
+    """Wraps a ``Master``, all methods return awaitables.
+
+    The ``executor`` defaults to the default executor of the running
+    loop."""
+
+    def __init__(self, master, executor=None):
+        self.master = master
+        self.executor = executor
+
+    @property
+    def id(self):
+        return self.master.id
+
+    def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    def exec_(self, *args, **kwargs):
+        """Run a command on the host, the result is ``(rc, out, err)``."""
+        return self._run(self.master._exec, *args, **kwargs)
+
+    def ezjail_admin(self, command, **kwargs):
+        return self._run(self.master.ezjail_admin, command, **kwargs)
+
+    def jail_state(self, name):
+        return self._run(self.master.jail_state, name)
+
+    def instance(self, instance_id):
+        return AsyncInstance(self, self.master.instances[instance_id])
+
+    @property
+    def instances(self):
+        return dict(
+            (k, AsyncInstance(self, v))
+            for k, v in self.master.instances.items()
+            if k != self.master.id)
+
+
+class AsyncInstance(object):
+    """Wraps an ezjail ``Instance``, all methods return awaitables.
+
+    ``start``, ``stop`` and ``terminate`` run the ploy hooks like the
+    commands do. Errors are raised like in the synchronous API, which
+    includes ``SystemExit``."""
+
+    def __init__(self, master, instance):
+        self.master = master
+        self.instance = instance
+
+    @property
+    def id(self):
+        return self.instance.id
+
+    def _command(self, command, **kwargs):
+        return self.master._run(
+            self.master.master.run_command, command, self.instance, **kwargs)
+
+    def create(self, overrides=None, jails=None):
+        return self._command('create', overrides=overrides, jails=jails)
+
+    def start(self, overrides=None, jails=None):
+        return self._command('start', overrides=overrides, jails=jails)
+
+    def stop(self, overrides=None, jails=None):
+        return self._command('stop', overrides=overrides, jails=jails)
+
+    def terminate(self, jails=None):
+        return self._command('terminate', jails=jails)
+
+    def status(self, jails=None):
+        """Return ``running``, ``stopped`` or ``unavailable``."""
+        return self.master._run(self.instance._status, jails)
+
+
+def get_masters(ctrl, executor=None):
+    """Return a dict of ``AsyncMaster`` for all ez-masters of ``ctrl``."""
+    return dict(
+        (k, AsyncMaster(v, executor=executor))
+        for k, v in ctrl.masters.items()
+        if isinstance(v, Master))
@@ -0,0 +1,576 @@
+"""Benchmarks for ploy_ezjail.
+
+Run all of them with ``python -m ploy_ezjail.benchmarks`` or pass the
+names of the ones to run as arguments.
+"""
+from __future__ import print_function, unicode_literals
+from collections import OrderedDict
+import base64
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+
+def make_ezjail_list(count, multi_ip_every=10):
+    """Return synthetic ``ezjail-admin list`` output for ``count`` jails.
+
+    Every ``multi_ip_every`` jail gets an additional IPv6 address on a
+    continuation line."""
+    lines = [
+        'STA JID  IP              Hostname                       Root Directory',
+        '--- ---- --------------- ------------------------------ ------------------------']
+    for i in range(count):
+        name = 'jail%d' % i
+        if i % 2:
+            status = 'ZS'
+            jid = 'N/A'
+        else:
+            status = 'ZR'
+            jid = str(i + 1)
+        ip = '10.%d.%d.%d' % (i // 65536, (i // 256) % 256, i % 256)
+        lines.append('%-3s %-4s %-15s %-30s /usr/jails/%s' % (
+            status, jid, ip, name, name))
+        if multi_ip_every and i % multi_ip_every == 0:
+            lines.append('    %-4s vtnet0|2a03:b0c0:3:d0::%x' % (jid, i))
+    return '\n'.join(lines).encode('utf-8')
+
+
+def legacy_parse(out):
+    """The dictionary based parser ``Master.ezjail_admin('list')`` used
+    before ``iter_ezjail_list``, kept for comparison."""
+    lines = out.decode('utf-8').splitlines()
+    headers = ('status', 'jid', 'ip', 'name', 'root')
+    padding = [''] * len(headers)
+    jails = {}
+    prev_entry = None
+    for line in lines[2:]:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('N/A') or line[0].isdigit():
+            jails[prev_entry]['ip'] = [jails[prev_entry]['ip'], line.split()[1]]
+        else:
+            entry = dict(zip(headers, line.split() + padding))
+            prev_entry = entry.pop('name')
+            jails[prev_entry] = entry
+    return jails
+
+
+def parse(out, names=None):
+    from ploy_ezjail import iter_ezjail_list, parse_list_headers
+    lines = out.decode('utf-8').splitlines()
+    parse_list_headers(lines[0], lines[1])
+    return dict(
+        (x.name, x) for x in iter_ezjail_list(lines[2:], names=names))
+
+
+def bench_list_parser(counts=(1000, 10000), repeat=5):
+    """Parsing of ``ezjail-admin list`` output."""
+    results = []
+    for count in counts:
+        out = make_ezjail_list(count)
+        name = 'jail%d' % (count // 2)
+        funcs = [
+            ('legacy dict parser', lambda: legacy_parse(out)),
+            ('all jails', lambda: parse(out)),
+            ('single jail', lambda: parse(out, names=[name]))]
+        baseline = None
+        for label, func in funcs:
+            best = min(timeit.repeat(func, number=1, repeat=repeat))
+            if baseline is None:
+                baseline = best
+            results.append(dict(
+                jails=count, case=label, seconds=best,
+                speedup=baseline / best if best else None))
+    return results
+
+
+ezjail_config_template = """# To specify the start up order of your ezjails, use these lines to
+# create a Jail dependency tree. See rcorder(8) for more details.
+#
+# PROVIDE: standard_ezjail
+# REQUIRE:
+# BEFORE:
+#
+
+export jail_{name}_hostname="{name}"
+export jail_{name}_ip="{ip}"
+export jail_{name}_rootdir="{root}"
+"""
+
+
+class SimulatedHost(object):
+    """A stand-in for the executor of a master which models an ezjail host.
+
+    It understands the commands the plugin sends, including the scripts of
+    batched ``RemoteSteps``, and keeps the state of the jails, files and
+    ZFS filesystems in memory. Every call sleeps for ``latency`` seconds
+    and is recorded in ``calls``."""
+
+    def __init__(self, jails=0, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = []
+        self.jails = OrderedDict()
+        self.files = {}
+        self.dirs = set()
+        self.datasets = {}
+        self.snapshots = set()
+        self.next_jid = 1
+        for i in range(jails):
+            self.add_jail(
+                'jail%d' % i,
+                '10.%d.%d.%d' % (i // 65536, (i // 256) % 256, i % 256),
+                running=i % 2 == 0)
+
+    def add_jail(self, name, ip, running=False):
+        root = '/usr/jails/%s' % name
+        self.jails[name] = dict(ip=ip, root=root, jid=None)
+        self.files['/usr/local/etc/ezjail/%s' % name] = ezjail_config_template.format(
+            name=name, ip=ip, root=root).encode('utf-8')
+        self.files['/etc/fstab.%s' % name] = (
+            '# fstab of %s created by ezjail\n' % name).encode('utf-8')
+        self.dirs.add(root)
+        if running:
+            self.start_jail(name)
+
+    def start_jail(self, name):
+        self.jails[name]['jid'] = self.next_jid
+        self.next_jid += 1
+
+    def __call__(self, *args, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        stdin = kwargs.get('stdin')
+        if stdin is not None and not isinstance(stdin, bytes):
+            stdin = stdin.encode('utf-8')
+        with self.lock:
+            self.calls.append(args)
+            return self.run(args, stdin)
+
+    def run(self, args, stdin=None):
+        if args[0] in self.files:
+            return self.run_file(args[0], args[1:])
+        command = os.path.basename(args[0])
+        handler = getattr(self, 'cmd_%s' % command.replace('-', '_'), None)
+        if handler is None:
+            return (127, b'', ('%s: not found\n' % args[0]).encode('utf-8'))
+        return handler(args[1:], stdin)
+
+    def run_file(self, path, args):
+        """Run an uploaded file, only the inventory agent is supported."""
+        from ploy_ezjail import inventory_agent_script, inventory_agent_version
+        if self.files[path] != inventory_agent_script.encode('utf-8'):
+            return self.run_echo_script(path)
+        jails = []
+        for name, jail in self.jails.items():
+            config_path = '/usr/local/etc/ezjail/%s' % name
+            prefix = 'export jail_%s_' % name
+            config = OrderedDict()
+            for line in self.files[config_path].decode('utf-8').splitlines():
+                if line.startswith(prefix):
+                    key, value = line[len(prefix):].split('=', 1)
+                    config[key] = value.strip('"')
+            jails.append(OrderedDict([
+                ('name', name),
+                ('status', 'ZS' if jail['jid'] is None else 'ZR'),
+                ('jid', 'N/A' if jail['jid'] is None else str(jail['jid'])),
+                ('root', jail['root']),
+                ('ips', jail['ip'].split(',')),
+                ('config', config)]))
+        out = json.dumps(dict(version=inventory_agent_version, jails=jails))
+        return (0, (out + '\n').encode('utf-8'), b'')
+
+    def run_echo_script(self, path):
+        """Run a shell script which only consists of ``echo`` lines."""
+        lines = self.files[path].decode('utf-8').splitlines()
+        if not lines or not lines[0].startswith('#!'):
+            return (126, b'', ('%s: Permission denied\n' % path).encode('utf-8'))
+        out = []
+        for line in lines[1:]:
+            if line.startswith('echo '):
+                out.extend(shlex.split(line)[1:2])
+            elif line and not line.startswith('#'):
+                return (1, b'', ('%s: unsupported script\n' % path).encode('utf-8'))
+        return (0, ''.join('%s\n' % x for x in out).encode('utf-8'), b'')
+
+    def cmd_ezjail_admin(self, args, stdin):
+        command, args = args[0], list(args[1:])
+        name = args[-1] if args else None
+        if command == 'list':
+            lines = [
+                'STA JID  IP              Hostname                       Root Directory',
+                '--- ---- --------------- ------------------------------ ------------------------']
+            for name, jail in self.jails.items():
+                if jail['jid'] is None:
+                    status, jid = 'ZS', 'N/A'
+                else:
+                    status, jid = 'ZR', str(jail['jid'])
+                lines.append('%-3s %-4s %-15s %-30s %s' % (
+                    status, jid, jail['ip'], name, jail['root']))
+            return (0, ('\n'.join(lines) + '\n').encode('utf-8'), b'')
+        if command == 'create':
+            name, ip = args[-2:]
+            if name in self.jails:
+                return (1, b'', b'Error: A jail with this name already exists.\n')
+            self.add_jail(name, ip)
+            return (0, b'', b'')
+        if name not in self.jails:
+            return (1, b'', ('Error: Nothing known about jail %s.\n' % name).encode('utf-8'))
+        if command in ('start', 'onestart'):
+            if self.jails[name]['jid'] is None:
+                self.start_jail(name)
+            return (0, b'', b'')
+        if command in ('stop', 'onestop'):
+            self.jails[name]['jid'] = None
+            return (0, b'', b'')
+        if command == 'delete':
+            if self.jails[name]['jid'] is not None:
+                return (1, b'', b'Error: Jail appears to be running.\n')
+            del self.jails[name]
+            self.files.pop('/usr/local/etc/ezjail/%s' % name, None)
+            self.files.pop('/etc/fstab.%s' % name, None)
+            return (0, b'', b'')
+        return (1, b'', ('Error: Unknown command %s.\n' % command).encode('utf-8'))
+
+    def find_jail(self, safename):
+        """Return the jail for the name ezjail uses for it."""
+        from ploy_ezjail import ezjail_safename
+        for name, jail in self.jails.items():
+            if ezjail_safename(name) == safename:
+                return jail
+
+    def cmd_jls(self, args, stdin):
+        jail = self.find_jail(args[1])
+        if jail is None or jail['jid'] is None:
+            return (1, b'', ('jls: jail "%s" not found\n' % args[1]).encode('utf-8'))
+        return (0, ('%d\n' % jail['jid']).encode('ascii'), b'')
+
+    def cmd_cat(self, args, stdin):
+        if args[0] not in self.files:
+            return (1, b'', ('cat: %s: No such file or directory\n' % args[0]).encode('utf-8'))
+        return (0, self.files[args[0]], b'')
+
+    def cmd_chmod(self, args, stdin):
+        if args[-1] not in self.files:
+            return (1, b'', b'chmod: No such file or directory\n')
+        return (0, b'', b'')
+
+    def cmd_mkdir(self, args, stdin):
+        self.dirs.add(args[-1])
+        return (0, b'', b'')
+
+    def cmd_zfs(self, args, stdin):
+        if args[0] == 'list':
+            paths = args[4:]
+            out = []
+            err = []
+            for path in paths:
+                if path in self.datasets:
+                    out.append('%s\t%s\n' % (path, self.datasets[path]))
+                else:
+                    err.append("cannot open '%s': dataset does not exist\n" % path)
+            return (
+                1 if err else 0,
+                ''.join(out).encode('utf-8'), ''.join(err).encode('utf-8'))
+        if args[0] == 'create':
+            self.datasets[args[-1]] = '/%s' % args[-1]
+            return (0, b'', b'')
+        if args[0] == 'clone':
+            if args[1] not in self.snapshots:
+                return (1, b'', ("cannot open '%s': dataset does not exist\n" % args[1]).encode('utf-8'))
+            mountpoint = '/usr/jails/%s' % args[2].rsplit('/', 1)[-1]
+            self.datasets[args[2]] = mountpoint
+            self.dirs.add(mountpoint)
+            return (0, b'', b'')
+        if args[0] == 'destroy':
+            self.datasets.pop(args[1], None)
+            return (0, b'', b'')
+        return (1, b'', b'zfs: unknown command\n')
+
+    def cmd_sh(self, args, stdin):
+        from ploy_ezjail import jail_state_script, missing_dirs_script
+        from ploy_ezjail import clone_jail_script, replace_file_script
+        from ploy_ezjail import file_hashes_script, upload_file_script
+        from ploy_ezjail import inventory_agent_check_script
+        if args[0] == '-s':
+            return self.run_script(stdin.decode('utf-8'))
+        script, params = args[1], args[2:]
+        if script == jail_state_script:
+            jail = self.find_jail(params[0])
+            if jail is None:
+                info = 'unavailable'
+            elif jail['jid'] is None:
+                info = 'stopped N/A %s' % jail['root']
+            else:
+                info = 'running %d %s' % (jail['jid'], jail['root'])
+            return (0, ('%s\n' % info).encode('utf-8'), b'')
+        if script == clone_jail_script:
+            snapshot, dataset, ezjail_admin, name, ip = params
+            result = self.run(('zfs', 'clone', snapshot, dataset))
+            if result[0] == 0:
+                keys = '%s/etc/ssh/ssh_host_' % self.datasets[dataset]
+                for path in [x for x in self.files if x.startswith(keys)]:
+                    del self.files[path]
+                result = self.run(
+                    (ezjail_admin, 'create', '-c', 'zfs', '-x', name, ip))
+                if result[0] != 0:
+                    self.run(('zfs', 'destroy', dataset))
+            return result
+        if script == missing_dirs_script:
+            missing = [x for x in params[1:] if x not in self.dirs]
+            return (0, ''.join('%s\n' % x for x in missing).encode('utf-8'), b'')
+        if script in (replace_file_script, upload_file_script):
+            self.files[params[0]] = stdin
+            return (0, b'', b'')
+        if script == inventory_agent_check_script:
+            if params[0] not in self.files:
+                state = 'missing'
+            elif params[1] in self.files[params[0]].decode('utf-8').splitlines()[:2]:
+                state = 'agent'
+            else:
+                state = 'other'
+            return (0, ('%s\n' % state).encode('ascii'), b'')
+        if script == file_hashes_script:
+            out = []
+            for path in params[1:]:
+                if path in self.files:
+                    out.append(hashlib.sha256(self.files[path]).hexdigest())
+                else:
+                    out.append('-')
+            return (0, ''.join('%s\n' % x for x in out).encode('ascii'), b'')
+        match = re.match(r'^cat - > "(.*)"$', script)
+        if match:
+            self.files[match.group(1)] = stdin
+            return (0, b'', b'')
+        return (1, b'', b'sh: unsupported script\n')
+
+    def run_script(self, script):
+        """Run a script created by ``RemoteSteps.script``."""
+        marker = re.search(r"echo '(PLOY-[0-9a-f]+) begin", script).group(1)
+        regexp = re.compile(
+            r"echo '%s begin (\d+)'\n(.*?)\nploy_rc=\$\?\n(.*?)(?=echo '%s begin|\Z)" % (
+                marker, marker), re.DOTALL)
+        out = []
+        for match in regexp.finditer(script):
+            index, cmd, trailer = match.groups()
+            stdin = None
+            if cmd.endswith(' </dev/null 2>"$ploy_err"'):
+                cmd = cmd[:-len(' </dev/null 2>"$ploy_err"')]
+            else:
+                lines = cmd.split('\n')
+                cmd = lines[0].split(' | ', 1)[1][:-len(' 2>"$ploy_err"')]
+                stdin = base64.b64decode(''.join(lines[1:-1]))
+            rc, step_out, step_err = self.run(tuple(shlex.split(cmd)), stdin)
+            out.append(b''.join([
+                ('%s begin %s\n' % (marker, index)).encode('ascii'),
+                step_out, b'\n',
+                ('%s stderr %s\n' % (marker, index)).encode('ascii'),
+                step_err, b'\n',
+                ('%s end %s %d\n' % (marker, index, rc)).encode('ascii')]))
+            if rc and '|| exit $ploy_rc' in trailer:
+                return (rc, b''.join(out), b'')
+        return (0, b''.join(out), b'')
+
+
+class SimulatedFleet(object):
+    """A ploy controller with ``masters`` ez-masters, each connected to a
+    ``SimulatedHost`` with ``jails`` jails.
+
+    The instances ``jail0`` (running), ``jail1`` (stopped) and ``new``
+    (not created) are configured for every master. With ``new`` set to
+    more than one, the additional instances ``new1`` and so on are not
+    created either. With ``agent`` set, the inventory agent is installed
+    on the hosts and used by the masters."""
+
+    agent_path = '/usr/local/libexec/ploy-ezjail-inventory'
+
+    def __init__(self, masters=1, jails=10, latency=0.0, new=1, agent=False):
+        from ploy import Controller
+        from ploy_ezjail import TimedExecutor, inventory_agent_script
+        import ploy_ezjail
+        self.directory = tempfile.mkdtemp()
+        lines = []
+        for i in range(masters):
+            lines.append('[ez-master:host%d]' % i)
+        instances = [('jail0', '10.0.0.0'), ('jail1', '10.0.0.1')]
+        self.new = ['new'] + ['new%d' % i for i in range(1, new)]
+        for i, name in enumerate(self.new):
+            instances.append((name, '10.1.%d.%d' % ((i + 1) // 256, (i + 1) % 256)))
+        for name, ip in instances:
+            lines.extend([
+                '[ez-instance:%s]' % name,
+                'ip = %s' % ip])
+        configfile = os.path.join(self.directory, 'ploy.conf')
+        with open(configfile, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.ctrl = Controller(configpath=self.directory)
+        self.ctrl.configfile = configfile
+        self.ctrl.plugins = {'ezjail': ploy_ezjail.plugin}
+        self.hosts = OrderedDict()
+        for master_id in sorted(self.ctrl.masters):
+            master = self.ctrl.masters[master_id]
+            host = self.hosts[master_id] = SimulatedHost(jails=jails, latency=latency)
+            master._exec = TimedExecutor(master, host)
+            if agent:
+                master.inventory_agent = self.agent_path
+                host.files[self.agent_path] = inventory_agent_script.encode('utf-8')
+
+    @property
+    def masters(self):
+        return [self.ctrl.masters[x] for x in self.hosts]
+
+    @property
+    def calls(self):
+        return sum(len(x.calls) for x in self.hosts.values())
+
+    def close(self):
+        shutil.rmtree(self.directory)
+
+
+def run_start(fleet):
+    fleet.masters[0].instances['jail1'].start()
+
+
+def run_create(fleet):
+    fleet.masters[0].instances['new'].start()
+
+
+def run_terminate(fleet):
+    fleet.masters[0].instances['jail0'].terminate()
+
+
+def run_status(fleet):
+    fleet.masters[0].instances['jail0'].status()
+
+
+def run_master_status(fleet):
+    fleet.masters[0].instance.status()
+
+
+def run_bulk_create(fleet):
+    master = fleet.masters[0]
+    master.bulk('create', [master.instances[x] for x in fleet.new])
+
+
+def run_fleet_status(fleet):
+    from ploy_ezjail import fleet_status
+    fleet_status(fleet.masters)
+
+
+simulated_operations = OrderedDict([
+    ('start', (dict(), run_start)),
+    ('create', (dict(), run_create)),
+    ('bulk create', (dict(new=40), run_bulk_create)),
+    ('terminate', (dict(), run_terminate)),
+    ('status', (dict(), run_status)),
+    ('master status', (dict(), run_master_status)),
+    ('master status (agent)', (dict(agent=True), run_master_status)),
+    ('fleet status', (dict(masters=4), run_fleet_status))])
+
+
+def measure(operation, jails, latency=0.0):
+    """Run ``operation`` from ``simulated_operations`` on a fresh simulated
+    fleet and return the number of remote calls and the time taken."""
+    kwargs, func = simulated_operations[operation]
+    fleet = SimulatedFleet(jails=jails, latency=latency, **kwargs)
+    try:
+        start = timeit.default_timer()
+        func(fleet)
+        seconds = timeit.default_timer() - start
+        return fleet.calls, seconds
+    finally:
+        fleet.close()
+
+
+def bench_simulated_host(counts=(10, 100, 1000), latency=0.005, repeat=3):
+    """Remote calls and wall time of operations on simulated hosts."""
+    results = []
+    for count in counts:
+        for operation in simulated_operations:
+            measurements = [
+                measure(operation, count, latency=latency)
+                for i in range(repeat)]
+            results.append(dict(
+                jails=count, case=operation,
+                calls=measurements[0][0],
+                seconds=min(x[1] for x in measurements)))
+    return results
+
+
+import_script = """
+import json, sys, timeit
+import ploy, ploy.common, ploy.config, ploy.plain
+before = set(sys.modules)
+start = timeit.default_timer()
+import ploy_ezjail
+seconds = timeit.default_timer() - start
+print(json.dumps(dict(
+    seconds=seconds, modules=sorted(set(sys.modules) - before))))
+"""
+
+
+def import_footprint():
+    """Import ``ploy_ezjail`` in a new interpreter after ``ploy`` and the
+    plugins it always loads. Returns the seconds the import took and the
+    names of the modules it added."""
+    out = subprocess.check_output([sys.executable, '-c', import_script])
+    result = json.loads(out.decode('utf-8'))
+    return result['seconds'], result['modules']
+
+
+def bench_import(repeat=5):
+    """Import of the plugin on top of ``ploy``."""
+    measurements = [import_footprint() for i in range(repeat)]
+    return [dict(
+        case='import ploy_ezjail',
+        modules=len(measurements[0][1]),
+        seconds=min(x[0] for x in measurements))]
+
+
+benchmarks = OrderedDict([
+    ('list_parser', bench_list_parser),
+    ('simulated_host', bench_simulated_host),
+    ('import', bench_import)])
+
+
+def format_result(result):
+    parts = []
+    for key, value in result.items():
+        if isinstance(value, float):
+            if key == 'seconds':
+                value = '%.2fms' % (value * 1000)
+            else:
+                value = '%.2f' % value
+        parts.append('%s=%s' % (key, value))
+    return ' '.join(parts)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    names = argv or list(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            print("Unknown benchmark '%s', choose from: %s" % (
+                name, ", ".join(benchmarks)), file=sys.stderr)
+            return 1
+    for name in names:
+        func = benchmarks[name]
+        print("%s: %s" % (name, func.__doc__))
+        for result in func():
+            print("    %s" % format_result(result))
+    return 0
+
+
+if __name__ == '__main__':  # pragma: nocover
+    sys.exit(main())
@@ -0,0 +1,7 @@
+import sys
+
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # uses async syntax and asyncio.run
+    collect_ignore.append('test_aio.py')
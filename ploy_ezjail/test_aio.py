@@ -0,0 +1,58 @@
+from __future__ import unicode_literals
+from ploy_ezjail import EzjailError
+from ploy_ezjail import aio
+from ploy_ezjail.test_ezjail import caplog_messages, ezjail_list, jail_state_cmd, jail_state_output
+import asyncio
+import ploy_ezjail.test_ezjail as base
+import pytest
+
+
+# fixtures shared with the main tests
+_exec = base._exec
+ctrl = base.ctrl
+ezjail_name = base.ezjail_name
+master_exec = base.master_exec
+
+
+def test_aio(ctrl, ezjail_name, master_exec, caplog, ployconf):
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        '[ez-instance:ham]',
+        'ip = 10.0.0.2'])
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(
+            {'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZR'},
+            {'name': 'ham', 'ip': '10.0.0.2', 'status': 'ZS'}), b''),
+        ('/usr/local/bin/ezjail-admin stop %s' % ezjail_name, 0, b'', b'')]
+    masters = aio.get_masters(ctrl)
+    assert list(masters) == ['warden']
+    master = masters['warden']
+    assert sorted(master.instances) == ['foo', 'ham']
+
+    async def run():
+        jails = await master.ezjail_admin('list')
+        states = await asyncio.gather(*[
+            x.status(jails) for x in master.instances.values()])
+        await master.instance('foo').stop(jails=jails)
+        return sorted(states)
+
+    assert asyncio.run(run()) == ['running', 'stopped']
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Stopping instance 'foo'",
+        "Instance stopped"]
+
+
+def test_aio_error(ctrl, ezjail_name, master_exec):
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name), b''),
+        ('/usr/local/bin/ezjail-admin stop %s' % ezjail_name, 1, b'', b'failed')]
+    instance = aio.get_masters(ctrl)['warden'].instance('foo')
+
+    async def run():
+        await instance.stop()
+
+    with pytest.raises(EzjailError):
+        asyncio.run(run())
+    assert master_exec.expect == []
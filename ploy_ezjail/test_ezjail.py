@@ -7,6 +7,7 @@ from hashlib import md5
 from ploy.common import shjoin
 from ploy.config import Config
 import logging
+import os
 import pytest
 import textwrap
 
@@ -58,6 +59,55 @@ def test_mounts_massager():
                     'ro': True},)}}
 
 
+def test_mounts_massager_cached(monkeypatch):
+    from ploy_ezjail import MountsMassager
+    monkeypatch.setattr(MountsMassager, '_parsed', {})
+    monkeypatch.setattr(MountsMassager, '_parsed_limit', 2)
+    parsed = []
+    parse = MountsMassager.parse
+
+    def counting_parse(self, value, sectionname):
+        parsed.append(value)
+        return parse(self, value, sectionname)
+
+    monkeypatch.setattr(MountsMassager, 'parse', counting_parse)
+    dummyplugin = DummyPlugin()
+    plugins = dict(
+        dummy=dict(
+            get_massagers=dummyplugin.get_massagers))
+    dummyplugin.massagers.append(MountsMassager('section', 'mounts'))
+    contents = StringIO("\n".join([
+        "[section:foo]",
+        "mounts = src=foo dst=/foo",
+        "[section:bar]",
+        "mounts = src=foo dst=/foo",
+        "[section:ham]",
+        "mounts = src=ham dst=/ham"]))
+    config = Config(contents, plugins=plugins).parse()
+    foo = config['section']['foo']['mounts']
+    assert config['section']['bar']['mounts'] == foo
+    assert parsed == ['src=foo dst=/foo']
+    # the cached mounts can't be changed through the result
+    foo[0]['src'] = 'changed'
+    assert config['section']['foo']['mounts'] == ({'src': 'foo', 'dst': '/foo'},)
+    assert config['section']['ham']['mounts'] == ({'src': 'ham', 'dst': '/ham'},)
+    assert parsed == ['src=foo dst=/foo', 'src=ham dst=/ham']
+    # the cache is bounded
+    assert len(MountsMassager._parsed) == 2
+    config['section']['ham']['mounts'] = 'src=egg dst=/egg'
+    assert config['section']['ham']['mounts'] == ({'src': 'egg', 'dst': '/egg'},)
+    assert len(MountsMassager._parsed) == 1
+
+
+def test_instance_massagers_cached():
+    from ploy_ezjail import get_instance_massagers
+    massagers = get_instance_massagers('ez-instance')
+    again = get_instance_massagers('ez-instance')
+    assert again == massagers
+    assert again is not massagers
+    assert [x.sectiongroupname for x in get_instance_massagers()] == ['instance'] * len(massagers)
+
+
 @pytest.fixture(params=['foo', 'bar'])
 def ezjail_name(request):
     return request.param
@@ -83,8 +133,11 @@ def ctrl(ployconf, ezjail_name):
 @pytest.fixture(autouse=True)
 def _exec(monkeypatch):
     from ploy_ezjail import Master
+    real_exec = Master.__dict__['_exec']
     # always fail if _exec is called
     monkeypatch.setattr(Master, '_exec', lambda *a, **k: 0 / 0)
+    # tests can put this back to use the real executor
+    return real_exec
 
 
 class MasterExec:
@@ -102,6 +155,8 @@ class MasterExec:
             expected = ('', 0, b'', b'')
         cmd_args, rc, out, err = expected
         assert cmd == cmd_args
+        if callable(out):
+            out = out(stdin)
         if stdin is not None:
             self.got.append((cmd, stdin))
         return (rc, out, err)
@@ -115,6 +170,50 @@ def master_exec(monkeypatch):
     return me
 
 
+def batched_output(*results):
+    """Return a function which creates the output of a batched
+    ``RemoteSteps`` script with the given ``(rc, out, err)`` results."""
+    import re
+
+    def output(script):
+        token = re.search(b'PLOY-([0-9a-f]+) begin', script).group(1)
+        marker = b'PLOY-' + token
+        lines = []
+        for index, (rc, out, err) in enumerate(results):
+            lines.extend([
+                marker + b' begin %d' % index, out,
+                marker + b' stderr %d' % index, err,
+                marker + b' end %d %d' % (index, rc)])
+        lines.append(b'')
+        return b'\n'.join(lines)
+
+    return output
+
+
+def ezjail_config(name, provide='standard_ezjail'):
+    return '\n'.join([
+        '# To specify the start up order of your ezjails, use these lines to',
+        '# create a Jail dependency tree. See rcorder(8) for more details.',
+        '#',
+        '# PROVIDE: %s' % provide,
+        '# REQUIRE:',
+        '# BEFORE:',
+        '#',
+        '',
+        'export jail_%s_hostname="%s"' % (name, name),
+        '']).encode('utf-8')
+
+
+def replace_file_cmd(path):
+    from ploy_ezjail import replace_file_script
+    return shjoin(['sh', '-c', replace_file_script, path])
+
+
+def upload_file_cmd(path, mode='0700'):
+    from ploy_ezjail import upload_file_script
+    return shjoin(['sh', '-c', upload_file_script, path, mode])
+
+
 def ezjail_list(*jails):
     lines = [
         'STA JID  IP              Hostname                       Root Directory',
@@ -199,23 +298,29 @@ def test_get_host(ctrl, ployconf):
 
 def test_start(ctrl, ezjail_name, master_exec, caplog):
     master_exec.expect = [
-        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(), b''),
         ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(), b''),
         ('/usr/local/bin/ezjail-admin create -c zfs %s 10.0.0.1' % ezjail_name, 0, b'', b''),
         ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b''),
-        ("""sh -c 'cat - > "/usr/jails/%s/etc/startup_script"'""" % ezjail_name, 0, b'', b''),
-        ('chmod 0700 /usr/jails/%s/etc/startup_script' % ezjail_name, 0, b'', b''),
-        ("""sh -c 'cat - > "/usr/jails/%s/etc/rc.d/ploy_startup_script"'""" % ezjail_name, 0, b'', b''),
-        ('chmod 0700 /usr/jails/%s/etc/rc.d/ploy_startup_script' % ezjail_name, 0, b'', b''),
-        ("""sed -i '' -e 's/\\# PROVIDE:.*$/\\# PROVIDE: standard_ezjail %s/' /usr/local/etc/ezjail/%s""" % (ezjail_name, ezjail_name), 0, b'', b''),
-        ('/usr/local/bin/ezjail-admin start %s' % ezjail_name, 0, b'', b'')]
+        (upload_file_cmd('/usr/jails/%s/etc/startup_script' % ezjail_name), 0, b'', b''),
+        (upload_file_cmd('/usr/jails/%s/etc/rc.d/ploy_startup_script' % ezjail_name), 0, b'', b''),
+        (replace_file_cmd('/usr/local/etc/ezjail/%s' % ezjail_name), 0, b'', b''),
+        ('/usr/local/bin/ezjail-admin start %s' % ezjail_name, 0, b'', b''),
+        ('jls -j %s jid' % ezjail_name, 0, b'1\n', b'')]
+    master_exec.expect.insert(3, (
+        'sh -s', 0, batched_output(
+            (0, ezjail_config(ezjail_name), b''),
+            (0, b'', b'')), b''))
     ctrl(['./bin/ploy', 'start', 'foo'])
     assert master_exec.expect == []
-    assert len(master_exec.got) == 2
-    assert master_exec.got[0][0] == """sh -c 'cat - > "/usr/jails/%s/etc/startup_script"'""" % ezjail_name
-    assert master_exec.got[0][1] == ''
-    assert master_exec.got[1][0] == """sh -c 'cat - > "/usr/jails/%s/etc/rc.d/ploy_startup_script"'""" % ezjail_name
-    assert 'PROVIDE: ploy_startup_script' in master_exec.got[1][1]
+    assert len(master_exec.got) == 4
+    assert master_exec.got[0][0] == 'sh -s'
+    assert b'cat /usr/local/etc/ezjail/%s' % ezjail_name.encode('ascii') in master_exec.got[0][1]
+    assert master_exec.got[1][0] == upload_file_cmd('/usr/jails/%s/etc/startup_script' % ezjail_name)
+    assert master_exec.got[1][1] == ''
+    assert master_exec.got[2][0] == upload_file_cmd('/usr/jails/%s/etc/rc.d/ploy_startup_script' % ezjail_name)
+    assert 'PROVIDE: ploy_startup_script' in master_exec.got[2][1]
+    assert master_exec.got[3][1] == ezjail_config(
+        ezjail_name, provide='standard_ezjail %s' % ezjail_name).decode('utf-8')
     assert caplog_messages(caplog) == [
         "Creating instance 'foo'",
         "Starting instance 'foo'"]
@@ -223,7 +328,6 @@ def test_start(ctrl, ezjail_name, master_exec, caplog):
 
 def test_master_status(ctrl, ezjail_name, master_exec, caplog):
     master_exec.expect = [
-        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b''),
         ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b'')]
     ctrl(['./bin/ploy', 'status', 'warden'])
     assert master_exec.expect == []
@@ -234,7 +338,6 @@ def test_master_status(ctrl, ezjail_name, master_exec, caplog):
 
 def test_master_status_jail_not_created(ctrl, ezjail_name, master_exec, caplog):
     master_exec.expect = [
-        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(), b''),
         ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(), b'')]
     ctrl(['./bin/ploy', 'status', 'warden'])
     assert master_exec.expect == []
@@ -245,7 +348,6 @@ def test_master_status_jail_not_created(ctrl, ezjail_name, master_exec, caplog):
 
 def test_master_status_unknown_jail(ctrl, ezjail_name, master_exec, caplog):
     master_exec.expect = [
-        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': 'ham', 'ip': '10.0.1.1', 'status': 'ZS'}), b''),
         ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': 'ham', 'ip': '10.0.1.1', 'status': 'ZS'}), b'')]
     ctrl(['./bin/ploy', 'status', 'warden'])
     assert master_exec.expect == []
@@ -262,7 +364,6 @@ def test_master_status_additional_jail(ctrl, ezjail_name, master_exec, caplog, p
         'ip = 10.0.0.2'])
     ployconf.fill(lines)
     master_exec.expect = [
-        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b''),
         ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b'')]
     ctrl(['./bin/ploy', 'status', 'warden'])
     assert master_exec.expect == []
@@ -279,7 +380,6 @@ def test_master_status_multi_ip(ctrl, ezjail_name, master_exec, caplog, ployconf
         'ip = 10.0.0.2'])
     ployconf.fill(lines)
     master_exec.expect = [
-        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': ['10.0.0.1', 'vtnet0|2a03:b0c0:3:d0::3a4d:c002'], 'status': 'ZS'}), b''),
         ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': ['10.0.0.1', 'vtnet0|2a03:b0c0:3:d0::3a4d:c002'], 'status': 'ZS'}), b'')]
     ctrl(['./bin/ploy', 'status', 'warden'])
     assert master_exec.expect == []
@@ -287,3 +387,1428 @@ def test_master_status_multi_ip(ctrl, ezjail_name, master_exec, caplog, ployconf
     assert caplog_messages(caplog) == [
         'foo                  stopped                10.0.0.1',
         'ham                  unavailable            10.0.0.2']
+
+
+def test_list_cache(ctrl, ezjail_name, master_exec, monkeypatch):
+    import ploy_ezjail
+    now = [100.0]
+    monkeypatch.setattr(ploy_ezjail, 'monotonic', lambda: now[0])
+    jails_output = ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'})
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, jails_output, b'')]
+    jails = master.ezjail_admin('list')
+    assert master_exec.expect == []
+    assert master.ezjail_admin('list') is jails
+    now[0] += master.jails_cache_ttl + 1
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, jails_output, b'')]
+    assert master.ezjail_admin('list') is not jails
+    assert master_exec.expect == []
+    master.invalidate_jails()
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, jails_output, b'')]
+    master.ezjail_admin('list')
+    assert master_exec.expect == []
+
+
+def test_list_cache_invalidated_by_stop(ctrl, ezjail_name, master_exec):
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZR'}), b''),
+        ('/usr/local/bin/ezjail-admin stop %s' % ezjail_name, 0, b'', b''),
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b'')]
+    instance = ctrl.instances['foo']
+    instance.master.ezjail_admin('list')
+    instance.stop()
+    instance.master.ezjail_admin('list')
+    assert instance._status() == 'stopped'
+    assert master_exec.expect == []
+
+
+def jail_state_cmd(name):
+    from ploy_ezjail import jail_state_script
+    return shjoin(['sh', '-c', jail_state_script, name])
+
+
+def jail_state_output(state, name, jid='N/A'):
+    if state == 'running' and jid == 'N/A':
+        jid = '1'
+    return ('%s %s /usr/jails/%s\n' % (state, jid, name)).encode('utf-8')
+
+
+def test_jail_state(ctrl, ezjail_name, master_exec):
+    from ploy_ezjail import EzjailError
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name), b''),
+        (jail_state_cmd('ham'), 0, b'unavailable\n', b''),
+        (jail_state_cmd('egg'), 1, b'', b'sh: not found')]
+    assert master.jail_state(ezjail_name) == 'running'
+    assert master.jail_state('ham') == 'unavailable'
+    with pytest.raises(EzjailError):
+        master.jail_state('egg')
+    assert master_exec.expect == []
+
+
+def test_jail_state_safename(ctrl, master_exec):
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        (jail_state_cmd('foo_example_com'), 0, b'stopped N/A /usr/jails/foo.example.com\n', b''),
+        ('jls -j foo_example_com jid', 0, b'1\n', b'')]
+    assert master.jail_state('foo.example.com') == 'stopped'
+    assert master.jail_running('foo.example.com')
+    assert master_exec.expect == []
+
+
+def test_jail_info(ctrl, ezjail_name, master_exec):
+    from ploy_ezjail import EzjailError
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, b'running 3 /usr/jails/my jail\n', b''),
+        (jail_state_cmd(ezjail_name), 0, b'stopped N/A /usr/jails/foo\n', b''),
+        (jail_state_cmd(ezjail_name), 0, b'unavailable\n', b''),
+        (jail_state_cmd(ezjail_name), 0, b'running\n', b'')]
+    assert master.jail_info(ezjail_name) == ('running', '3', '/usr/jails/my jail')
+    assert master.jail_info(ezjail_name) == ('stopped', 'N/A', '/usr/jails/foo')
+    assert master.jail_info(ezjail_name) == ('unavailable', None, None)
+    with pytest.raises(EzjailError):
+        master.jail_info(ezjail_name)
+    assert master_exec.expect == []
+
+
+def test_jail_state_attached(ctrl, ezjail_name, master_exec):
+    from ploy_ezjail import EzjailError
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('attached', ezjail_name), b'')]
+    with pytest.raises(EzjailError) as e:
+        master.jail_state(ezjail_name)
+    assert e.value.args[0] == "Don't know how to handle mounted but not running jail '%s'" % ezjail_name
+    assert master_exec.expect == []
+
+
+def test_stop_attached_jail(ctrl, ezjail_name, master_exec, caplog):
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('attached', ezjail_name), b'')]
+    ctrl(['./bin/ploy', 'stop', 'foo'])
+    assert master_exec.expect == []
+    assert "Don't know how to handle mounted but not running jail '%s'" % ezjail_name in caplog.text
+
+
+def test_stop_single_jail_query(ctrl, ezjail_name, master_exec, caplog):
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name), b''),
+        ('/usr/local/bin/ezjail-admin stop %s' % ezjail_name, 0, b'', b'')]
+    ctrl(['./bin/ploy', 'stop', 'foo'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Stopping instance 'foo'",
+        "Instance stopped"]
+
+
+def test_list_unknown_headers(ctrl, master_exec):
+    from ploy_ezjail import EzjailError
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, b'STA JID  Hostname\n--- ---- --------', b'')]
+    with pytest.raises(EzjailError) as e:
+        master.ezjail_admin('list')
+    assert e.value.args[0].startswith('ezjail-admin list output has unknown headers')
+
+
+def test_list_headers_memoized(ctrl, ezjail_name, master_exec, monkeypatch):
+    import ploy_ezjail
+    calls = []
+    parse_list_headers = ploy_ezjail.parse_list_headers
+
+    def _parse_list_headers(*args):
+        calls.append(args)
+        return parse_list_headers(*args)
+
+    monkeypatch.setattr(ploy_ezjail, 'parse_list_headers', _parse_list_headers)
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(), b''),
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'status': 'ZS'}), b'')]
+    assert master.ezjail_admin('list') == {}
+    master.invalidate_jails()
+    assert list(master.ezjail_admin('list')) == [ezjail_name]
+    assert master_exec.expect == []
+    assert len(calls) == 1
+
+
+class LocalMaster:
+    def __init__(self):
+        from ploy.common import LocalExecutor
+        self._exec = LocalExecutor()
+
+
+def test_remote_steps_batched(monkeypatch, tmpdir):
+    import ploy_ezjail
+    monkeypatch.setattr(ploy_ezjail, 'b64decode_args', ('base64', '-d'))
+    steps = ploy_ezjail.RemoteSteps()
+    dest = tmpdir.join('startup_script').strpath
+    steps.add(('sh', '-c', 'cat - > "%s"' % dest), stdin=b'\x00binary\nscript', error="Creation failed.")
+    steps.add(('cat', dest))
+    steps.add(('sh', '-c', 'echo foo; echo bar >&2; exit 3'))
+    steps.add(('sh', '-c', 'echo fatal >&2; exit 1'), error="Fatal.")
+    steps.add(('sh', '-c', 'echo never'))
+    results = steps.run(LocalMaster(), batched=True)
+    assert tmpdir.join('startup_script').read_binary() == b'\x00binary\nscript'
+    assert [(x.rc, x.out, x.err) for x in results] == [
+        (0, b'', b''),
+        (0, b'\x00binary\nscript', b''),
+        (3, b'foo\n', b'bar\n'),
+        (1, b'', b'fatal\n')]
+    assert results[-1].step.error == "Fatal."
+
+
+def test_remote_steps_sequential(tmpdir):
+    import ploy_ezjail
+    steps = ploy_ezjail.RemoteSteps()
+    steps.add(('sh', '-c', 'exit 2'))
+    steps.add(('sh', '-c', 'echo fatal >&2; exit 1'), error="Fatal.")
+    steps.add(('sh', '-c', 'echo never'))
+    results = steps.run(LocalMaster())
+    assert [(x.rc, x.out, x.err) for x in results] == [
+        (2, b'', b''),
+        (1, b'', b'fatal\n')]
+
+
+def test_jail_config_substitutions(ctrl, ezjail_name, ployconf):
+    from ploy_ezjail import apply_substitutions
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        'rc_require = ham',
+        'jail_hostname = foo\\1.example.com'])
+    ployconf.fill(lines)
+    instance = ctrl.instances['foo']
+    config = ezjail_config(ezjail_name).decode('utf-8')
+    result = apply_substitutions(
+        config, instance._get_jail_config_substitutions())
+    assert result.splitlines() == [
+        '# To specify the start up order of your ezjails, use these lines to',
+        '# create a Jail dependency tree. See rcorder(8) for more details.',
+        '#',
+        '# PROVIDE: standard_ezjail %s' % ezjail_name,
+        '# REQUIRE: ham',
+        '# BEFORE:',
+        '#',
+        '',
+        'export jail_%s_hostname="foo\\1.example.com"' % ezjail_name]
+    assert result.endswith('\n')
+    assert apply_substitutions(
+        result, instance._get_jail_config_substitutions()) == result
+
+
+def test_start_batched(ctrl, ezjail_name, master_exec, caplog, ployconf):
+    lines = ployconf.content().splitlines()
+    lines.insert(lines.index('[ez-master:warden]') + 1, 'ezjail-batch-provisioning = yes')
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(), b''),
+        ('/usr/local/bin/ezjail-admin create -c zfs %s 10.0.0.1' % ezjail_name, 0, b'', b''),
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b''),
+        ('sh -s', 0, batched_output(
+            (0, ezjail_config(ezjail_name), b''),
+            (0, b'', b'')), b''),
+        ('sh -s', 0, batched_output(
+            (0, b'', b''),
+            (0, b'', b''),
+            (0, b'', b'')), b''),
+        ('/usr/local/bin/ezjail-admin start %s' % ezjail_name, 0, b'', b''),
+        ('jls -j %s jid' % ezjail_name, 0, b'1\n', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    ((cmd, read_script), (cmd, script)) = master_exec.got
+    script = script.decode('utf-8')
+    assert '/usr/jails/%s/etc/startup_script' % ezjail_name in script
+    assert '/usr/jails/%s/etc/rc.d/ploy_startup_script' % ezjail_name in script
+    assert '/usr/local/etc/ezjail/%s' % ezjail_name in script
+    assert caplog_messages(caplog) == [
+        "Creating instance 'foo'",
+        "Starting instance 'foo'"]
+
+
+@pytest.mark.parametrize('output, message', [
+    ((1, b'', b'sudo: a password is required'), "sudo: a password is required"),
+    ((0, batched_output((0, b'', b'')), b''), "Commands on 'warden' stopped after 1 of 3 steps.")])
+def test_start_batched_script_fails(ctrl, ezjail_name, master_exec, caplog, ployconf, output, message):
+    lines = ployconf.content().splitlines()
+    lines.insert(lines.index('[ez-master:warden]') + 1, 'ezjail-batch-provisioning = yes')
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(), b''),
+        ('/usr/local/bin/ezjail-admin create -c zfs %s 10.0.0.1' % ezjail_name, 0, b'', b''),
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b''),
+        ('sh -s', 0, batched_output(
+            (0, ezjail_config(ezjail_name), b''),
+            (0, b'', b'')), b''),
+        ('sh -s',) + output]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog)[-1] == message
+
+
+def test_start_mounts(ctrl, ezjail_name, master_exec, caplog, ployconf, confext):
+    if confext == '.yml':
+        pytest.skip("multi line mounts are converted to a list in yaml")
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        'mounts =',
+        '    src=/srv/{name} dst=/srv create=yes',
+        '    src=/static dst=/mnt/static ro=yes'])
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b''),
+        ('sh -s', 0, batched_output(
+            (0, ezjail_config(ezjail_name, provide='standard_ezjail %s' % ezjail_name), b''),
+            (0, b'# fstab written by ezjail\n', b''),
+            (0, ('/srv/%s\n/usr/jails/%s/srv' % (ezjail_name, ezjail_name)).encode('ascii'), b'')), b''),
+        ('mkdir -p /srv/%s' % ezjail_name, 0, b'', b''),
+        ('mkdir -p /usr/jails/%s/srv' % ezjail_name, 0, b'', b''),
+        (replace_file_cmd('/etc/fstab.%s' % ezjail_name), 0, b'', b''),
+        ('/usr/local/bin/ezjail-admin start %s' % ezjail_name, 0, b'', b''),
+        ('jls -j %s jid' % ezjail_name, 0, b'1\n', b'')]
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    read_script = master_exec.got[0][1]
+    assert b'/usr/jails/%s/mnt/static' % ezjail_name.encode('ascii') in read_script
+    fstab = [
+        '# fstab written by ezjail',
+        '# mount points from ploy',
+        '/srv/%s /usr/jails/%s/srv nullfs rw 0 0' % (ezjail_name, ezjail_name),
+        '/static /usr/jails/%s/mnt/static nullfs ro 0 0' % ezjail_name]
+    assert master_exec.got[1][1].splitlines() == fstab
+    assert caplog_messages(caplog) == [
+        "Setting up mount points",
+        "Starting instance 'foo'"]
+    # when nothing changed, nothing is written on the next start
+    caplog.clear()
+    master_exec.got = []
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b''),
+        ('sh -s', 0, batched_output(
+            (0, ezjail_config(ezjail_name, provide='standard_ezjail %s' % ezjail_name), b''),
+            (0, '\n'.join(fstab + ['']).encode('ascii'), b''),
+            (0, b'', b'')), b''),
+        ('/usr/local/bin/ezjail-admin start %s' % ezjail_name, 0, b'', b''),
+        ('jls -j %s jid' % ezjail_name, 0, b'1\n', b'')]
+    ctrl.masters['warden'].invalidate_jails()
+    ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    assert len(master_exec.got) == 1
+
+
+def test_start_mount_source_creation_fails(ctrl, ezjail_name, master_exec, caplog, ployconf):
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        'mounts = src=/srv/{name} dst=/srv create=yes'])
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list({'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b''),
+        ('sh -s', 0, batched_output(
+            (0, ezjail_config(ezjail_name), b''),
+            (0, b'# fstab written by ezjail\n', b''),
+            (0, ('/srv/%s\n/usr/jails/%s/srv' % (ezjail_name, ezjail_name)).encode('ascii'), b'')), b''),
+        (replace_file_cmd('/usr/local/etc/ezjail/%s' % ezjail_name), 0, b'', b''),
+        ('mkdir -p /srv/%s' % ezjail_name, 1, b'', b'Permission denied')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'start', 'foo'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Setting up mount points",
+        "Couldn't create source directory '/srv/%s' for mountpoint '/srv/{name}'." % ezjail_name,
+        "Permission denied"]
+
+
+def test_zfs_resolve(ctrl, master_exec, caplog, ployconf):
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        '[ez-zfs:data]',
+        'path = tank/data',
+        '[ez-zfs:shared]',
+        'path = {zfs[data][path]}/shared',
+        'create = yes',
+        'set-compression = lz4',
+        '[ez-zfs:backup]',
+        'path = tank/backup'])
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('zfs list -H -o name,mountpoint tank/data tank/data/shared', 1,
+         b'tank/data\t/tank/data\n',
+         b"cannot open 'tank/data/shared': dataset does not exist\n"),
+        ('sh -s', 0, batched_output(
+            (0, b'', b''),
+            (0, b'tank/data/shared\t/mnt/shared', b'')), b''),
+        ('zfs list -H -o name,mountpoint tank/backup', 1, b'',
+         b"cannot open 'tank/backup': dataset does not exist\n")]
+    zfs = ctrl.masters['warden'].zfs
+    zfs.resolve(['data', 'shared'])
+    assert str(zfs['data']) == '/tank/data'
+    assert str(zfs['shared']) == '/mnt/shared'
+    with pytest.raises(SystemExit):
+        str(zfs['backup'])
+    assert master_exec.expect == []
+    script = master_exec.got[0][1]
+    assert b"zfs create -o compression=lz4 tank/data/shared" in script
+    assert b"zfs list -H -o name,mountpoint tank/data/shared" in script
+    assert caplog_messages(caplog) == [
+        "Trying to use non existing zfs filesystem 'backup' at 'tank/backup'."]
+
+
+def test_zfs_resolve_only_used():
+    from ploy_ezjail import benchmarks
+    fleet = benchmarks.SimulatedFleet(masters=2, jails=3)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        host.datasets['tank/data'] = '/tank/data'
+        master.main_config['ez-zfs'] = {
+            'data': {'path': 'tank/data'},
+            'other': {'path': 'otherpool/stuff', 'create': True}}
+        master.instances['new'].config['mounts'] = 'src={zfs[data]}/{name} dst=/data create=yes'
+        master.instances['new'].start()
+        assert [x for x in host.calls if x[:2] == ('zfs', 'list')] == [
+            ('zfs', 'list', '-H', '-o', 'name,mountpoint', 'tank/data')]
+        assert 'otherpool/stuff' not in host.datasets
+    finally:
+        fleet.close()
+
+
+def test_zfs_create_fails(ctrl, master_exec, caplog, ployconf):
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        '[ez-zfs:data]',
+        'path = tank/data',
+        'create = yes'])
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('zfs list -H -o name,mountpoint tank/data', 1, b'',
+         b"cannot open 'tank/data': dataset does not exist\n"),
+        ('sh -s', 1, batched_output(
+            (1, b'', b'permission denied')), b'')]
+    with pytest.raises(SystemExit):
+        ctrl.masters['warden'].zfs['data'].mountpoint
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        "Couldn't create zfs filesystem 'data' at 'tank/data'.",
+        "permission denied"]
+
+
+def test_zfs_cache(ctrl, master_exec, ployconf, monkeypatch):
+    from ploy_ezjail import ZFS
+    import json
+    import os
+    import time
+    lines = ployconf.content().splitlines()
+    lines.insert(lines.index('[ez-master:warden]') + 1, 'ezjail-zfs-cache-ttl = 3600')
+    lines.extend([
+        '[ez-zfs:data]',
+        'path = tank/data',
+        '[ez-zfs:backup]',
+        'path = tank/backup'])
+    ployconf.fill(lines)
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        ('zfs list -H -o name,mountpoint tank/data', 0, b'tank/data\t/tank/data\n', b''),
+        ('zfs list -H -o name,mountpoint tank/backup', 0, b'tank/backup\t/tank/backup\n', b'')]
+    assert str(master.zfs['data']) == '/tank/data'
+    cache_path = os.path.join(ployconf.directory, 'ezjail-zfs-warden.json')
+    assert master.zfs.cache_path == cache_path
+    with open(cache_path) as f:
+        assert json.load(f)['mountpoints'] == {'tank/data': '/tank/data'}
+    # filesystems resolved later are added to the cache
+    assert str(master.zfs['backup']) == '/tank/backup'
+    assert master_exec.expect == []
+    with open(cache_path) as f:
+        assert json.load(f)['mountpoints'] == {
+            'tank/backup': '/tank/backup', 'tank/data': '/tank/data'}
+    # a new process uses the cache without asking the host
+    assert str(ZFS(master)['data']) == '/tank/data'
+    # an expired cache is refreshed
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 3600)
+    master_exec.expect = [
+        ('zfs list -H -o name,mountpoint tank/data', 0, b'tank/data\t/mnt/data\n', b'')]
+    zfs = ZFS(master)
+    assert str(zfs['data']) == '/mnt/data'
+    assert master_exec.expect == []
+    zfs.invalidate()
+    assert not os.path.exists(cache_path)
+    master_exec.expect = [
+        ('zfs list -H -o name,mountpoint tank/data', 0, b'tank/data\t/tank/data\n', b'')]
+    assert str(zfs['data']) == '/tank/data'
+    assert master_exec.expect == []
+
+
+def test_zfs_cache_disabled(ctrl, master_exec, ployconf):
+    import os
+    # the cache is disabled by default
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        '[ez-zfs:data]',
+        'path = tank/data'])
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('zfs list -H -o name,mountpoint tank/data', 0, b'tank/data\t/tank/data\n', b'')]
+    zfs = ctrl.masters['warden'].zfs
+    assert str(zfs['data']) == '/tank/data'
+    assert master_exec.expect == []
+    assert not os.path.exists(zfs.cache_path)
+
+
+def test_zfs_resolve_concurrent():
+    from ploy_ezjail import benchmarks
+    fleet = benchmarks.SimulatedFleet(jails=3, new=6, latency=0.02)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        host.datasets['tank/data'] = '/tank/data'
+        master.main_config['ez-zfs'] = {'data': {'path': 'tank/data'}}
+        for name in fleet.new:
+            master.instances[name].config['mounts'] = (
+                'src={zfs[data]}/{name} dst=/data create=yes')
+        results = master.bulk(
+            'start', [master.instances[x] for x in fleet.new])
+        assert [x.error for x in results.values()] == [None] * 6
+        assert len([x for x in host.calls if x[:2] == ('zfs', 'list')]) == 1
+        assert '/tank/data/new5' in host.dirs
+    finally:
+        fleet.close()
+
+
+def test_bulk_stop(ctrl, ezjail_name, master_exec, caplog, ployconf):
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        '[ez-instance:ham]',
+        'ip = 10.0.0.2'])
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(
+            {'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZR'},
+            {'name': 'ham', 'ip': '10.0.0.2', 'status': 'ZR'}), b''),
+        ('/usr/local/bin/ezjail-admin stop %s' % ezjail_name, 0, b'', b''),
+        ('/usr/local/bin/ezjail-admin stop ham', 1, b'', b'failed')]
+    master = ctrl.masters['warden']
+    results = master.bulk(
+        'stop', [ctrl.instances['foo'], ctrl.instances['ham']], workers=1)
+    assert master_exec.expect == []
+    assert list(results) == ['foo', 'ham']
+    assert results['foo'].error is None
+    assert results['ham'].error == 'failed'
+
+
+def test_bulk_invalid(ctrl):
+    master = ctrl.masters['warden']
+    with pytest.raises(ValueError):
+        master.bulk('list', [ctrl.instances['foo']])
+
+
+def test_bulk_cmd(ctrl, ezjail_name, master_exec, caplog, ployconf):
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        '[ez-instance:ham]',
+        'ip = 10.0.0.2'])
+    lines.insert(lines.index('[ez-master:warden]') + 1, 'ezjail-bulk-workers = 1')
+    ployconf.fill(lines)
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(
+            {'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'},
+            {'name': 'ham', 'ip': '10.0.0.2', 'status': 'ZR'}), b''),
+        ('/usr/local/bin/ezjail-admin stop ham', 0, b'', b'')]
+    ctrl(['./bin/ploy', 'ez-bulk', 'stop', '-m', 'warden'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog) == [
+        'Instance state: stopped',
+        'Instance not stopped',
+        "Stopping instance 'ham'",
+        'Instance stopped',
+        'warden-foo                     stop: ok',
+        'warden-ham                     stop: ok']
+
+
+def test_bulk_cmd_failure(ctrl, ezjail_name, master_exec, caplog):
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(
+            {'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZR'}), b''),
+        ('/usr/local/bin/ezjail-admin stop %s' % ezjail_name, 1, b'', b'failed')]
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'ez-bulk', 'stop', 'foo'])
+    assert master_exec.expect == []
+    assert caplog_messages(caplog)[-1] == 'warden-foo                     stop: failed'
+
+
+@pytest.fixture
+def fleet(ctrl, ployconf, monkeypatch):
+    from ploy_ezjail import Master
+    import multiprocessing.pool
+    import threading
+
+    class FleetLists(dict):
+        pass
+
+    lines = ployconf.content().splitlines()
+    lines.insert(lines.index('[ez-instance:foo]') + 1, 'master = warden')
+    lines.extend([
+        '[ez-instance:ham]',
+        'master = warden',
+        'ip = 10.0.0.2',
+        '[ez-master:tower]',
+        '[ez-instance:egg]',
+        'master = tower',
+        'ip = 10.0.1.1',
+        '[ez-master:slow]'])
+    ployconf.fill(lines)
+    lists = FleetLists()
+    release = threading.Event()
+
+    def _exec(master, *args, **kw):
+        assert shjoin(args) == '/usr/local/bin/ezjail-admin list'
+        if master.id == 'slow':
+            release.wait(5)
+        return lists[master.id]
+
+    monkeypatch.setattr(Master, '_exec', _exec)
+    lists.pools = pools = []
+    ThreadPool = multiprocessing.pool.ThreadPool
+
+    class RecordingPool(ThreadPool):
+        def __init__(self, *args, **kw):
+            ThreadPool.__init__(self, *args, **kw)
+            self.calls = []
+            pools.append(self)
+
+        def terminate(self):
+            self.calls.append('terminate')
+            ThreadPool.terminate(self)
+
+        def join(self):
+            self.calls.append('join')
+            ThreadPool.join(self)
+
+    monkeypatch.setattr(multiprocessing.pool, 'ThreadPool', RecordingPool)
+    yield lists
+    release.set()
+
+
+def test_fleet_status(ctrl, ezjail_name, fleet, caplog):
+    fleet['warden'] = (0, ezjail_list(
+        {'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZR'},
+        {'name': 'ham', 'ip': '10.0.0.3', 'status': 'ZR'},
+        {'name': 'spam', 'ip': '10.0.0.9', 'status': 'ZS'}), b'')
+    fleet['tower'] = (1, b'', b'failed')
+    fleet['slow'] = (0, ezjail_list(), b'')
+    with pytest.raises(SystemExit):
+        ctrl(['./bin/ploy', 'ez-status', '-t', '0.2'])
+    assert caplog_messages(caplog) == [
+        'slow: timed out after 0.2 seconds',
+        'tower: failed',
+        'warden:',
+        '    foo                  running                10.0.0.1',
+        '    ham                  running         10.0.0.3 != configured 10.0.0.2',
+        '    Unknown jail found: spam                        10.0.0.9',
+        '2 running, 0 stopped, 0 unavailable, 1 unknown, 1 ip mismatches, 2 of 3 masters failed']
+    # the pool isn't joined while the slow master is still stuck
+    assert [x.calls for x in fleet.pools] == [['terminate']]
+
+
+def test_fleet_status_json(ctrl, ezjail_name, fleet, capsys):
+    import json
+    fleet['warden'] = (0, ezjail_list(
+        {'name': ezjail_name, 'ip': '10.0.0.1', 'status': 'ZS'}), b'')
+    fleet['tower'] = (0, ezjail_list(
+        {'name': 'egg', 'ip': '10.0.1.1', 'status': 'ZR'}), b'')
+    ctrl(['./bin/ploy', 'ez-status', '--json', 'tower', 'warden'])
+    report = json.loads(capsys.readouterr().out)
+    assert list(report) == ['tower', 'warden']
+    assert report['tower'] == dict(error=None, jails=[dict(
+        instance='egg', name='egg', status='running', ip='10.0.1.1',
+        jail_ip='10.0.1.1', ip_mismatch=False)])
+    assert report['warden'] == dict(error=None, jails=[
+        dict(
+            instance='foo', name=ezjail_name, status='stopped',
+            ip='10.0.0.1', jail_ip='10.0.0.1', ip_mismatch=False),
+        dict(
+            instance='ham', name='ham', status='unavailable',
+            ip='10.0.0.2', jail_ip=None, ip_mismatch=False)])
+    assert [x.calls for x in fleet.pools] == [['join']]
+
+
+def test_terminate_waits_for_stop(ctrl, ezjail_name, master_exec, caplog, monkeypatch):
+    import ploy_ezjail
+    sleeps = []
+    monkeypatch.setattr(ploy_ezjail.time, 'sleep', sleeps.append)
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name), b''),
+        ('/usr/local/bin/ezjail-admin stop %s' % ezjail_name, 0, b'', b''),
+        ('jls -j %s jid' % ezjail_name, 0, b'1\n', b''),
+        ('jls -j %s jid' % ezjail_name, 0, b'1\n', b''),
+        ('jls -j %s jid' % ezjail_name, 1, b'', b'jls: jail "%s" not found' % ezjail_name.encode('ascii')),
+        ('/usr/local/bin/ezjail-admin delete -fw %s' % ezjail_name, 0, b'', b'')]
+    ctrl.instances['foo'].terminate()
+    assert master_exec.expect == []
+    assert sleeps == [0.1, 0.2]
+    assert caplog_messages(caplog) == [
+        "Stopping instance 'foo'",
+        "Waiting for jail to stop",
+        "Terminating instance 'foo'",
+        "Instance terminated"]
+
+
+def test_wait_for_jail_timeout(ctrl, ezjail_name, master_exec, monkeypatch):
+    import ploy_ezjail
+    now = [0.0]
+
+    def sleep(delay):
+        now[0] += delay
+
+    monkeypatch.setattr(ploy_ezjail, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(ploy_ezjail.time, 'sleep', sleep)
+    master_exec.expect = [
+        ('jls -j %s jid' % ezjail_name, 1, b'', b'')] * 6
+    master = ctrl.masters['warden']
+    with pytest.raises(ploy_ezjail.EzjailError) as e:
+        master.wait_for_jail(ezjail_name, 'running', timeout=2)
+    assert master_exec.expect == []
+    assert e.value.args[0] == "Jail '%s' not running after 2 seconds." % ezjail_name
+    assert now[0] == 2
+
+
+def test_get_fingerprints(ctrl, ezjail_name, master_exec):
+    import ploy_ezjail
+    keygen_output = (
+        b'2048 SHA256:Sn0ZiHmVgBAGdyLADbqbXGWWyCgNrVQrTmAs2oIa3ig root@foo (RSA)\n'
+        b'256 SHA256:JK6jtmw9RSrOVZ/pAWPbqxRDRoShXyR4WYDtP/uVb2A root@foo (ED25519)\n')
+
+    def jexec(jid):
+        return shjoin(['jexec', jid, 'sh', '-c', ploy_ezjail.fingerprints_script])
+    read_keys = shjoin(['sh', '-c', ploy_ezjail.public_keys_script, '/usr/jails/%s' % ezjail_name])
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name, jid='5'), b''),
+        (read_keys, 0, b'', b''),
+        (jexec('5'), 0, keygen_output, b'')]
+    instance = ctrl.instances['foo']
+    fingerprints = instance.get_fingerprints()
+    assert master_exec.expect == []
+    assert [(x['keytype'], x['keylen']) for x in fingerprints] == [
+        ('rsa', 2048), ('ed25519', 256)]
+    # cached as long as the jail id stays the same
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name, jid='5'), b'')]
+    assert instance.get_fingerprints() == fingerprints
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name, jid='6'), b''),
+        (read_keys, 1, b'', b''),
+        (jexec('6'), 0, keygen_output.splitlines(True)[0], b'')]
+    assert len(instance.get_fingerprints()) == 1
+    assert master_exec.expect == []
+
+
+def test_get_fingerprints_from_root(ctrl, ezjail_name, master_exec):
+    from ploy.common import SSHKeyFingerprint, SSHKeyInfo
+    import paramiko
+    import ploy_ezjail
+    keys = [paramiko.RSAKey.generate(1024), paramiko.ECDSAKey.generate()]
+    read_keys = shjoin(['sh', '-c', ploy_ezjail.public_keys_script, '/usr/jails/%s' % ezjail_name])
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name), b''),
+        (read_keys, 0, "".join(
+            "%s %s root@%s\n" % (x.get_name(), x.get_base64(), ezjail_name)
+            for x in keys).encode('ascii'), b'')]
+    instance = ctrl.instances['foo']
+    fingerprints = instance.get_fingerprints()
+    assert master_exec.expect == []
+    assert [(x['keytype'], x['keylen']) for x in fingerprints] == [
+        ('rsa', 1024), ('ecdsa', 256)]
+    for key, info in zip(keys, fingerprints):
+        assert SSHKeyFingerprint(**info) in SSHKeyInfo(key)
+    master_exec.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name), b'')]
+    assert instance.get_fingerprint() == str(SSHKeyFingerprint(**fingerprints[0]))
+    assert master_exec.expect == []
+
+
+@pytest.mark.skipif(not os.path.exists('/bin/sh'), reason="needs /bin/sh")
+def test_public_keys_script(tmpdir):
+    from ploy_ezjail import public_keys_script
+    import subprocess
+    ssh = tmpdir.mkdir('jail').mkdir('etc').mkdir('ssh')
+    ssh.join('ssh_host_ed25519_key.pub').write('ssh-ed25519 AAAA root@foo')
+    ssh.join('ssh_host_rsa_key.pub').write('x' * 20000)
+    tmpdir.join('host_key').write('secret\n')
+    ssh.join('ssh_host_dsa_key.pub').mksymlinkto(tmpdir.join('host_key'))
+    os.mkfifo(str(ssh.join('ssh_host_ecdsa_key.pub')))
+    root = str(tmpdir.join('jail'))
+    out = subprocess.check_output(['/bin/sh', '-c', public_keys_script, root])
+    assert out.splitlines() == [b'ssh-ed25519 AAAA root@foo', b'x' * 16384]
+    # a symlinked /etc/ssh isn't followed either
+    tmpdir.mkdir('other').join('etc').mksymlinkto(ssh.dirpath())
+    out = subprocess.check_output(
+        ['/bin/sh', '-c', public_keys_script, str(tmpdir.join('other'))])
+    assert out == b''
+
+
+def test_parse_public_key_invalid():
+    from ploy_ezjail import parse_public_key
+    assert parse_public_key('') is None
+    assert parse_public_key('ssh-rsa') is None
+    assert parse_public_key('ssh-rsa !!!') is None
+    assert parse_public_key('ssh-rsa AAAAB3NzaC1yc2EAAAADAQAB') is None
+    assert parse_public_key('foo AAAAA2Zvbw==') is None
+
+
+@pytest.fixture
+def local_shell_executor(monkeypatch):
+    import ploy_ezjail
+    import subprocess
+    monkeypatch.setattr(ploy_ezjail, 'b64decode_args', ('base64', '-d'))
+    processes = []
+
+    class Instance:
+        uid = 'local'
+
+    def open_session():
+        # like the channel with combined stderr
+        proc = subprocess.Popen(
+            ['sh', '-c', 'echo "sudo: unable to resolve host" >&2; exec sh'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        processes.append(proc)
+        return ploy_ezjail.ShellSession(
+            proc.stdin, proc.stdout, close=proc.stdin.close)
+
+    executor = ploy_ezjail.ShellExecutor(Instance())
+    executor._open_session = open_session
+    executor.processes = processes
+    yield executor
+    executor.close()
+    for proc in processes:
+        proc.stdin.close()
+        proc.wait()
+
+
+def test_shell_executor(local_shell_executor, tmpdir):
+    executor = local_shell_executor
+    assert executor('sh', '-c', 'echo foo; echo bar >&2; exit 3') == (3, b'foo\n', b'bar\n')
+    assert executor('printf', '%s', "it's") == (0, b"it's", b'')
+    dest = tmpdir.join('data').strpath
+    data = b'\x00binary\nPLOY data' * 100
+    assert executor('sh', '-c', 'cat - > "$0"', dest, stdin=data) == (0, b'', b'')
+    assert tmpdir.join('data').read_binary() == data
+    assert executor('cat', dest) == (0, data, b'')
+    assert executor('cat', '-') == (0, b'', b'')
+    assert len(executor.processes) == 1
+
+
+def test_shell_executor_concurrent(local_shell_executor):
+    from multiprocessing.pool import ThreadPool
+    executor = local_shell_executor
+    pool = ThreadPool(4)
+    results = pool.map(lambda x: executor('echo', str(x)), range(20))
+    pool.close()
+    pool.join()
+    assert results == [(0, ('%d\n' % x).encode('ascii'), b'') for x in range(20)]
+    assert 1 <= len(executor.processes) <= 4
+
+
+def test_shell_executor_broken_session(local_shell_executor):
+    from ploy_ezjail import EzjailError
+    executor = local_shell_executor
+    with pytest.raises(EzjailError):
+        executor('sh', '-c', 'kill -9 $PPID')
+    assert executor('echo', 'foo') == (0, b'foo\n', b'')
+    assert len(executor.processes) == 2
+
+
+def test_shell_executor_stderr(local_shell_executor, monkeypatch):
+    import ploy_ezjail
+    executor = local_shell_executor
+    monkeypatch.setattr(
+        ploy_ezjail, 'b64decode_args',
+        ('sh', '-c', 'echo broken input >&2; base64 -d'))
+    assert executor('cat', stdin=b'foo') == (0, b'foo', b'broken input\n')
+    # errors of the shell itself don't end up in the responses
+    assert executor('sh', '-c', 'echo foo; echo bar >&2') == (0, b'foo\n', b'bar\n')
+    executor._idle[0]._write('no_such_command\n')
+    assert executor('echo', 'foo') == (0, b'foo\n', b'')
+    assert len(executor.processes) == 1
+
+
+def test_persistent_shell_option(ctrl, ployconf, monkeypatch, _exec):
+    from ploy_ezjail import Master, ShellExecutor
+    monkeypatch.setattr(Master, '_exec', _exec)
+    lines = ployconf.content().splitlines()
+    lines.insert(lines.index('[ez-master:warden]') + 1, 'ezjail-persistent-shell = yes')
+    lines.insert(lines.index('[ez-master:warden]') + 1, 'sudo = yes')
+    ployconf.fill(lines)
+    executor = ctrl.masters['warden']._exec.executor
+    assert isinstance(executor, ShellExecutor)
+    assert executor.prefix_args == ('sudo',)
+    closed = []
+    executor._idle.append(fake_shell_session(closed))
+    ctrl.instances['warden'].close_conn()
+    assert closed == [True]
+    assert executor._idle == []
+
+
+def fake_shell_session(closed):
+    from ploy_ezjail import ShellSession
+
+    class FakeSession(ShellSession):
+        def __init__(self):
+            self._close = lambda: closed.append(True)
+
+    return FakeSession()
+
+
+def test_master_instances(ctrl, ployconf, monkeypatch, _exec):
+    from ploy_ezjail import Master
+    monkeypatch.setattr(Master, '_exec', _exec)
+    lines = ployconf.content().splitlines()
+    lines.extend([
+        '[ez-instance:ham]',
+        'master = warden tower',
+        'ip = 10.0.0.2',
+        '[ez-instance:egg]',
+        'master = tower',
+        'ip = 10.0.1.1',
+        '[ez-master:tower]'])
+    ployconf.fill(lines)
+    masters = ctrl.masters
+    assert sorted(masters['warden'].instances) == ['foo', 'ham', 'warden']
+    assert sorted(masters['tower'].instances) == ['egg', 'foo', 'ham', 'tower']
+    assert masters['tower'].instances['ham'].master is masters['tower']
+    assert masters['warden'].instances['ham'].master is masters['warden']
+    assert masters['warden'].instances['ham'].sectiongroupname == 'ez-instance'
+    assert sorted(ctrl.instances) == [
+        'egg', 'tower', 'tower-egg', 'tower-foo', 'tower-ham',
+        'warden', 'warden-foo', 'warden-ham']
+    # the executor is only created on first use
+    assert '_exec' not in masters['warden'].__dict__
+    assert masters['warden']._exec.executor.instance is masters['warden'].instance
+
+
+class FakeInstanceExecutor:
+    def __init__(self, instance, prefix_args=()):
+        self.expect = []
+
+    def __call__(self, *cmd_args, **kw):
+        cmd, rc, out, err = self.expect.pop(0)
+        assert shjoin(cmd_args) == cmd
+        return (rc, out, err)
+
+
+def test_timing(ctrl, ezjail_name, ployconf, monkeypatch, caplog, _exec):
+    import json
+    import ploy_ezjail
+    monkeypatch.setattr(ploy_ezjail.Master, '_exec', _exec)
+    monkeypatch.setattr(ploy_ezjail, 'InstanceExecutor', FakeInstanceExecutor)
+    registered = []
+    monkeypatch.setattr(ploy_ezjail.atexit, 'register', lambda *a: registered.append(a))
+    lines = ployconf.content().splitlines()
+    lines.insert(lines.index('[ez-master:warden]') + 1, 'ezjail-timing-summary = yes')
+    lines.insert(lines.index('[ez-master:warden]') + 1, 'ezjail-timing-log = timing.jsonl')
+    ployconf.fill(lines)
+    master = ctrl.masters['warden']
+    master._exec.executor.expect = [
+        (jail_state_cmd(ezjail_name), 0, jail_state_output('running', ezjail_name), b''),
+        ('/usr/local/bin/ezjail-admin stop %s' % ezjail_name, 0, b'', b'stopped'),
+        ('jls -j %s jid' % ezjail_name, 1, b'', b'')]
+    master.instances['foo'].stop()
+    master._exec('jls', '-j', ezjail_name, 'jid')
+    assert master._exec.executor.expect == []
+    assert [(x.operation, x.command, x.args, x.rc, x.bytes_out) for x in master.timings.spans] == [
+        ('stop', 'sh', ('-c', ploy_ezjail.jail_state_script, ezjail_name), 0, len(jail_state_output('running', ezjail_name))),
+        ('stop', 'ezjail-admin stop', ('stop', ezjail_name), 0, 7),
+        (None, 'jls', ('-j', ezjail_name, 'jid'), 1, 0)]
+    with open(ployconf.directory + '/timing.jsonl') as f:
+        spans = [json.loads(x) for x in f]
+    assert [x['command'] for x in spans] == ['sh', 'ezjail-admin stop', 'jls']
+    assert spans[0]['master'] == 'warden'
+    ((func, title),) = registered
+    caplog.clear()
+    func(title)
+    messages = caplog_messages(caplog)
+    assert messages[0] == "Remote commands of ez-master 'warden':"
+    assert messages[1].split() == ['operation', 'command', 'count', 'total', 'max', 'in', 'out']
+    assert len(messages) == 5
+
+
+def test_timing_counts_bytes(ctrl, monkeypatch, _exec):
+    import ploy_ezjail
+    monkeypatch.setattr(ploy_ezjail.Master, '_exec', _exec)
+    monkeypatch.setattr(ploy_ezjail, 'InstanceExecutor', FakeInstanceExecutor)
+    master = ctrl.masters['warden']
+    spans = []
+    master.span_listeners.append(spans.append)
+    master._exec.executor.expect = [
+        ('cat', 0, '\xfcber\n', b'')]
+    master._exec('cat', stdin='gr\xfc\xdfe')
+    assert [(x.bytes_in, x.bytes_out) for x in spans] == [(7, 6)]
+
+
+def test_iter_ezjail_list():
+    from ploy_ezjail import Jail, iter_ezjail_list
+    lines = ezjail_list(
+        {'name': 'foo', 'status': 'ZR', 'jid': 5, 'ip': ['10.0.0.1', 'em0|148.73.5.8', 'vtnet0|2a03:b0c0:3:d0::3a4d:c002']},
+        {'name': 'bar', 'status': 'ZS', 'ip': ['10.0.0.2', 'vtnet0|2a03:b0c0:3:d0::3a4d:c003']},
+        {'name': 'ham', 'status': 'ZS', 'jid': 3, 'ip': '10.0.0.3'}).decode('utf-8').splitlines()[2:]
+    jails = list(iter_ezjail_list(lines))
+    assert [x.name for x in jails] == ['foo', 'bar', 'ham']
+    assert jails[0] == Jail('ZR', '5', ('10.0.0.1', 'em0|148.73.5.8', 'vtnet0|2a03:b0c0:3:d0::3a4d:c002'), 'foo', '/usr/jails/foo')
+    assert jails[0].ip == '10.0.0.1,em0|148.73.5.8,vtnet0|2a03:b0c0:3:d0::3a4d:c002'
+    assert jails[0]['root'] == '/usr/jails/foo'
+    assert jails[0].get('foo') is None
+    assert jails[2].ip == '10.0.0.3'
+    jails = list(iter_ezjail_list(lines, names=['bar']))
+    assert [(x.name, x.ips) for x in jails] == [
+        ('bar', ('10.0.0.2', 'vtnet0|2a03:b0c0:3:d0::3a4d:c003'))]
+    assert list(iter_ezjail_list(lines, names=['foo', 'ham', 'egg'])) == [
+        Jail('ZR', '5', ('10.0.0.1', 'em0|148.73.5.8', 'vtnet0|2a03:b0c0:3:d0::3a4d:c002'), 'foo', '/usr/jails/foo'),
+        Jail('ZS', '3', ('10.0.0.3',), 'ham', '/usr/jails/ham')]
+
+
+def test_iter_ezjail_list_invalid():
+    from ploy_ezjail import EzjailError, iter_ezjail_list
+    with pytest.raises(EzjailError):
+        list(iter_ezjail_list(['    73   vtnet0|2a03:b0c0:3:d0::3a4d:c002']))
+    with pytest.raises(EzjailError):
+        list(iter_ezjail_list(['ZR  73   10.0.0.1']))
+
+
+def test_list_names(ctrl, master_exec):
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        ('/usr/local/bin/ezjail-admin list', 0, ezjail_list(
+            {'name': 'foo', 'status': 'ZR'}, {'name': 'bar', 'status': 'ZS'}), b'')]
+    assert list(master.ezjail_admin('list', names=['bar'])) == ['bar']
+    assert sorted(master.ezjail_admin('list')) == ['bar', 'foo']
+    assert list(master.ezjail_admin('list', names=['foo'])) == ['foo']
+    assert master_exec.expect == []
+
+
+def test_benchmark_list_parser():
+    from ploy_ezjail import benchmarks
+    out = benchmarks.make_ezjail_list(25)
+    legacy = benchmarks.legacy_parse(out)
+    jails = benchmarks.parse(out)
+    assert sorted(legacy) == sorted(jails)
+    for name, jail in jails.items():
+        assert legacy[name]['status'] == jail.status
+        assert legacy[name]['root'] == jail.root
+    results = benchmarks.bench_list_parser(counts=(25,), repeat=1)
+    assert [x['case'] for x in results] == [
+        'legacy dict parser', 'all jails', 'single jail']
+
+
+def test_import_footprint():
+    from ploy_ezjail import benchmarks
+    seconds, modules = benchmarks.import_footprint()
+    # everything else is already loaded by ploy itself or deferred until used
+    assert set(modules) <= set(['ploy_ezjail', 'ploy.proxy'])
+    results = benchmarks.bench_import(repeat=1)
+    assert results[0]['modules'] == len(modules)
+
+
+def test_simulated_host(monkeypatch):
+    import ploy_ezjail
+    from ploy_ezjail import benchmarks
+    fleet = benchmarks.SimulatedFleet(jails=3)
+    try:
+        master = fleet.masters[0]
+        monkeypatch.setattr(master, 'batch_provisioning', True)
+        host = fleet.hosts[master.id]
+        master.instances['new'].start()
+        assert host.jails['new']['jid'] is not None
+        assert 'PROVIDE: standard_ezjail new' in host.files['/usr/local/etc/ezjail/new'].decode('utf-8')
+        assert host.files['/usr/jails/new/etc/rc.d/ploy_startup_script'] == ploy_ezjail.rc_startup.encode('utf-8')
+        master.instances['jail0'].terminate()
+        assert 'jail0' not in host.jails
+        assert master.instances['jail0']._status() == 'unavailable'
+    finally:
+        fleet.close()
+
+
+@pytest.mark.parametrize('jails', [10, 1000])
+def test_simulated_call_counts(jails):
+    from ploy_ezjail import benchmarks
+    calls = dict(
+        (x, benchmarks.measure(x, jails)[0])
+        for x in benchmarks.simulated_operations)
+    assert calls == {
+        'start': 5,
+        'create': 9,
+        'bulk create': 4,
+        'terminate': 4,
+        'status': 1,
+        'master status': 1,
+        'master status (agent)': 1,
+        'fleet status': 4}
+    results = benchmarks.bench_simulated_host(counts=(10,), latency=0, repeat=1)
+    assert [x['calls'] for x in results] == [
+        calls[x] for x in benchmarks.simulated_operations]
+
+
+def test_inventory_agent():
+    from ploy_ezjail import benchmarks
+    from ploy_ezjail import inventory_agent_script, upload_file_script
+    fleet = benchmarks.SimulatedFleet(jails=5)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        scraped = master.ezjail_admin('list')
+        master.invalidate_jails()
+        master.inventory_agent = fleet.agent_path
+        del host.calls[:]
+        # the missing agent is installed and the list is used this time
+        assert master.ezjail_admin('list') == scraped
+        assert [x[:3] for x in host.calls] == [
+            (fleet.agent_path,),
+            ('sh', '-c', upload_file_script),
+            ('/usr/local/bin/ezjail-admin', 'list')]
+        assert host.files[fleet.agent_path] == inventory_agent_script.encode('utf-8')
+        master.invalidate_jails()
+        del host.calls[:]
+        assert master.ezjail_admin('list') == scraped
+        assert master.ezjail_admin('list', names=['jail1']) == {'jail1': scraped['jail1']}
+        assert host.calls == [(fleet.agent_path,)]
+        # an outdated agent is only replaced once
+        host.files[fleet.agent_path] = b'#!/bin/sh\necho old\n'
+        master.invalidate_jails()
+        del host.calls[:]
+        assert master.ezjail_admin('list') == scraped
+        assert [x[0] for x in host.calls] == [
+            fleet.agent_path, '/usr/local/bin/ezjail-admin']
+    finally:
+        fleet.close()
+
+
+def test_inventory_agent_outdated():
+    from ploy_ezjail import benchmarks
+    from ploy_ezjail import inventory_agent_check_script
+    from ploy_ezjail import inventory_agent_script, upload_file_script
+    fleet = benchmarks.SimulatedFleet(jails=5, agent=True)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        host.files[fleet.agent_path] = b'\n'.join([
+            b'#!/bin/sh',
+            b'# ploy_ezjail inventory agent',
+            b'echo \'{"version": 1, "jails": []}\'',
+            b''])
+        del host.calls[:]
+        assert sorted(master.ezjail_admin('list')) == [
+            'jail%d' % i for i in range(5)]
+        assert [x[:3] for x in host.calls] == [
+            (fleet.agent_path,),
+            ('sh', '-c', inventory_agent_check_script),
+            ('sh', '-c', upload_file_script),
+            ('/usr/local/bin/ezjail-admin', 'list')]
+        assert host.files[fleet.agent_path] == inventory_agent_script.encode('utf-8')
+    finally:
+        fleet.close()
+
+
+def test_inventory_agent_foreign_file(caplog):
+    from ploy_ezjail import benchmarks
+    from ploy_ezjail import inventory_agent_check_script
+    fleet = benchmarks.SimulatedFleet(jails=5, agent=True)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        tool = b'#!/bin/sh\necho hello\n'
+        host.files[fleet.agent_path] = tool
+        del host.calls[:]
+        assert sorted(master.ezjail_admin('list')) == [
+            'jail%d' % i for i in range(5)]
+        assert [x[:3] for x in host.calls] == [
+            (fleet.agent_path,),
+            ('sh', '-c', inventory_agent_check_script),
+            ('/usr/local/bin/ezjail-admin', 'list')]
+        assert host.files[fleet.agent_path] == tool
+        assert "isn't usable and wasn't installed by ploy_ezjail" in caplog.text
+        # the file is only checked once
+        master.invalidate_jails()
+        del host.calls[:]
+        master.ezjail_admin('list')
+        assert [x[0] for x in host.calls] == [
+            fleet.agent_path, '/usr/local/bin/ezjail-admin']
+        assert host.files[fleet.agent_path] == tool
+    finally:
+        fleet.close()
+
+
+def test_parse_inventory():
+    from ploy_ezjail import Jail, parse_inventory
+    out = b'{"version": 2, "jails": [{"name": "foo", "status": "ZR", "jid": "3", "root": "/usr/jails/foo", "ips": ["10.0.0.1", "10.0.0.2"], "config": {"hostname": "foo"}}]}\n'
+    jails = parse_inventory(out)
+    assert jails == {
+        'foo': Jail('ZR', '3', ('10.0.0.1', '10.0.0.2'), 'foo', '/usr/jails/foo')}
+    assert jails['foo'].config == {'hostname': 'foo'}
+    assert jails['foo']['config'] == {'hostname': 'foo'}
+    with pytest.raises(ValueError):
+        parse_inventory(b'{"version": 1, "jails": []}')
+    with pytest.raises(ValueError):
+        parse_inventory(b'STA JID  IP')
+
+
+@pytest.mark.skipif(not os.path.exists('/bin/sh'), reason="needs /bin/sh")
+def test_inventory_agent_script(tmpdir):
+    from ploy_ezjail import EzjailError, inventory_agent_script, parse_inventory
+    import subprocess
+    bin = tmpdir.mkdir('bin')
+    bin.join('jls').write('#!/bin/sh\necho "3 /usr/jails/foo"\n')
+    bin.join('zfs').write('#!/bin/sh\necho /usr/jails/foo\n')
+    bin.join('mount').write('#!/bin/sh\necho "/dev/md0 /usr/jails/bar.baz ufs rw 2 2"\n')
+    bin.join('jls').chmod(0o755)
+    bin.join('zfs').chmod(0o755)
+    bin.join('mount').chmod(0o755)
+    conf = tmpdir.mkdir('ezjail')
+    conf.join('foo').write('\n'.join([
+        'export jail_foo_hostname="foo"',
+        'export jail_foo_ip="lo1|127.0.1.1,10.0.0.1"',
+        'export jail_foo_rootdir="/usr/jails/foo"',
+        '']))
+    conf.join('bar_baz.norun').write('\n'.join([
+        'export jail_bar_baz_hostname="bar.baz"',
+        'export jail_bar_baz_ip="10.0.0.2"',
+        'export jail_bar_baz_rootdir="/usr/jails/bar.baz/"',
+        'export jail_bar_baz_image="/usr/jails/bar.baz.img"',
+        'export jail_bar_baz_x="say \\"hi\\""',
+        'export jail_bar_baz_parameters="a=1',
+        '\tb=2\x01',
+        '"',
+        '']))
+    agent = tmpdir.join('agent')
+    agent.write(inventory_agent_script)
+    env = dict(os.environ, PATH='%s:%s' % (bin, os.environ.get('PATH', '')))
+    out = subprocess.check_output(['/bin/sh', str(agent), str(conf)], env=env)
+    jails = parse_inventory(out)
+    assert sorted(jails) == ['bar.baz', 'foo']
+    assert jails['foo'].state == 'running'
+    assert jails['foo'].jid == '3'
+    assert jails['foo'].ips == ('127.0.1.1', '10.0.0.1')
+    assert jails['bar.baz'].status == 'IA'
+    with pytest.raises(EzjailError):
+        jails['bar.baz'].state
+    assert jails['bar.baz'].root == '/usr/jails/bar.baz'
+    assert jails['bar.baz'].config['x'] == 'say "hi"'
+    assert jails['bar.baz'].config['parameters'] == 'a=1\n\tb=2\x01\n'
+    assert jails['bar.baz'].config['image'] == '/usr/jails/bar.baz.img'
+    assert jails['foo'].config['hostname'] == 'foo'
+    empty = subprocess.check_output(
+        ['/bin/sh', str(agent), str(tmpdir.mkdir('empty'))], env=env)
+    assert parse_inventory(empty) == {}
+
+
+def test_call_budget():
+    from ploy_ezjail import CallCounter
+    from ploy_ezjail import benchmarks
+    fleet = benchmarks.SimulatedFleet(jails=100)
+    try:
+        master = fleet.masters[0]
+        with CallCounter(master, limit=5) as counter:
+            master.instances['jail1'].start()
+        assert counter.counts == {'start': 5}
+        with CallCounter(fleet.masters, limit=1) as counter:
+            master.instance.status()
+        assert counter.counts == {'status': 1}
+        with pytest.raises(AssertionError) as e:
+            with CallCounter(master, limit=2):
+                master.instances['jail0'].terminate()
+        # the state comes from the jail list cached by the status above
+        assert e.value.args[0] == (
+            "3 remote commands exceed the budget of 2:\n"
+            "host0 terminate ezjail-admin stop\n"
+            "host0 terminate jls\n"
+            "host0 terminate ezjail-admin delete")
+        assert master.span_listeners == []
+    finally:
+        fleet.close()
+
+
+def test_bulk_create():
+    from ploy_ezjail import benchmarks
+    fleet = benchmarks.SimulatedFleet(jails=3, new=3)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        instances = [master.instances[x] for x in ('jail0', 'new', 'new1', 'new2')]
+        results = master.bulk('create', instances)
+        assert list(results) == ['jail0', 'new', 'new1', 'new2']
+        assert [(x.result, x.error) for x in results.values()] == [
+            (None, None), (True, None), (True, None), (True, None)]
+        assert [x[:2] for x in host.calls] == [
+            ('/usr/local/bin/ezjail-admin', 'list'),
+            ('sh', '-s'),
+            ('/usr/local/bin/ezjail-admin', 'list'),
+            ('sh', '-s')]
+        for name in ('new', 'new1', 'new2'):
+            assert host.jails[name]['jid'] is None
+            assert host.files['/usr/jails/%s/etc/rc.d/ploy_startup_script' % name]
+    finally:
+        fleet.close()
+
+
+def test_bulk_create_validation():
+    from ploy_ezjail import benchmarks
+    fleet = benchmarks.SimulatedFleet(jails=3, new=5)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        master.instances['new'].config.pop('ip')
+        master.instances['new1'].config['ip'] = '10.0.0.2'
+        master.instances['new2'].config['ip'] = '10.1.0.9'
+        master.instances['new3'].config['ip'] = 'lo1|10.1.0.9'
+        master.instances['new4'].config['ezjail-flavour'] = 'foo bar'
+        results = master.bulk(
+            'create', [master.instances[x] for x in fleet.new])
+        assert dict((k, v.error) for k, v in results.items()) == {
+            'new': "No IP address set",
+            'new1': "IP address '10.0.0.2' is used by 'jail2', 'new1'",
+            'new2': "IP address '10.1.0.9' is used by 'new2', 'new3'",
+            'new3': "IP address '10.1.0.9' is used by 'new2', 'new3'",
+            'new4': "The value 'foo bar' contains whitespace"}
+        assert len(host.calls) == 1
+    finally:
+        fleet.close()
+
+
+def test_start_clone():
+    from ploy_ezjail import benchmarks
+    from ploy_ezjail import clone_jail_script
+    fleet = benchmarks.SimulatedFleet(jails=3, new=3)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        host.snapshots.add('tank/golden@base')
+        master.jail_zfs = 'tank/jails'
+        for name in fleet.new:
+            instance = master.instances[name]
+            instance.config['ezjail-flavour'] = 'base'
+            instance.config['ezjail-clone'] = 'tank/golden@{flavour}'
+        # the host keys of the snapshot
+        host.files['/usr/jails/new/etc/ssh/ssh_host_rsa_key'] = b'key'
+        master.instances['new'].start()
+        assert host.calls[1][:4] == ('sh', '-c', clone_jail_script, 'tank/golden@base')
+        assert host.calls[1][4:] == ('tank/jails/new', '/usr/local/bin/ezjail-admin', 'new', '10.1.0.1')
+        assert host.datasets['tank/jails/new'] == '/usr/jails/new'
+        assert host.jails['new']['jid'] is not None
+        assert host.files['/usr/jails/new/etc/rc.d/ploy_startup_script']
+        assert '/usr/jails/new/etc/ssh/ssh_host_rsa_key' not in host.files
+        results = master.bulk(
+            'create', [master.instances[x] for x in ('new1', 'new2')])
+        assert [x.error for x in results.values()] == [None, None]
+        assert sorted(host.datasets) == [
+            'tank/jails/new', 'tank/jails/new1', 'tank/jails/new2']
+    finally:
+        fleet.close()
+
+
+def test_create_large_startup_script_no_hashes():
+    from ploy_ezjail import benchmarks
+    from ploy_ezjail import file_hashes_script
+    fleet = benchmarks.SimulatedFleet(jails=3, new=2)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        for name in fleet.new:
+            master.instances[name].startup_script = lambda overrides=None: '#' * 100000
+        master.instances['new'].start()
+        results = master.bulk('create', [master.instances['new1']])
+        assert [x.error for x in results.values()] == [None]
+        commands = [x[:3] for x in host.calls]
+        assert ('sh', '-c', file_hashes_script) not in commands
+        for name in fleet.new:
+            assert host.files['/usr/jails/%s/etc/startup_script' % name] == b'#' * 100000
+    finally:
+        fleet.close()
+
+
+@pytest.mark.skipif(not os.path.exists('/bin/sh'), reason="needs /bin/sh")
+def test_clone_jail_script_removes_host_keys(tmpdir):
+    from ploy_ezjail import clone_jail_script
+    import subprocess
+    root = tmpdir.mkdir('jail')
+    ssh = root.mkdir('etc').mkdir('ssh')
+    for name in ('ssh_host_rsa_key', 'ssh_host_rsa_key.pub', 'ssh_host_ed25519_key', 'ssh_host_ed25519_key.pub', 'sshd_config'):
+        ssh.join(name).write(name)
+    bin = tmpdir.mkdir('bin')
+    bin.join('zfs').write('#!/bin/sh\n[ "$1" = get ] && echo "%s"\nexit 0\n' % root)
+    bin.join('ezjail-admin').write('#!/bin/sh\necho "$@"\n')
+    bin.join('zfs').chmod(0o755)
+    bin.join('ezjail-admin').chmod(0o755)
+    env = dict(os.environ, PATH='%s:%s' % (bin, os.environ.get('PATH', '')))
+    out = subprocess.check_output([
+        '/bin/sh', '-c', clone_jail_script, 'tank/golden@base', 'tank/jails/new',
+        str(bin.join('ezjail-admin')), 'new', '10.0.0.1'], env=env)
+    assert out == b'create -c zfs -x new 10.0.0.1\n'
+    assert sorted(x.basename for x in ssh.listdir()) == ['sshd_config']
+
+
+def test_start_clone_skips_unchanged_startup_files():
+    from ploy_ezjail import benchmarks
+    from ploy_ezjail import file_hashes_script, rc_startup, upload_file_script
+    fleet = benchmarks.SimulatedFleet(jails=3, new=2)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        host.snapshots.add('tank/golden@base')
+        master.jail_zfs = 'tank/jails'
+        for name in fleet.new:
+            master.instances[name].config['ezjail-clone'] = 'tank/golden@base'
+        # the cloned snapshot already contains the rc script
+        for name in fleet.new:
+            host.files['/usr/jails/%s/etc/rc.d/ploy_startup_script' % name] = (
+                rc_startup.encode('utf-8'))
+        master.instances['new'].start()
+        commands = [x[:3] for x in host.calls]
+        assert ('sh', '-c', file_hashes_script) in commands
+        uploads = [
+            x[3] for x in host.calls if x[:3] == ('sh', '-c', upload_file_script)]
+        assert uploads == ['/usr/jails/new/etc/startup_script']
+        del host.calls[:]
+        results = master.bulk('create', [master.instances['new1']])
+        assert [x.error for x in results.values()] == [None]
+        assert len([x for x in host.calls if x[:3] == ('sh', '-c', file_hashes_script)]) == 1
+        assert '/usr/jails/new1/etc/startup_script' in host.files
+    finally:
+        fleet.close()
+
+
+def test_file_hashes(ctrl, master_exec):
+    from ploy_ezjail import content_hash, file_hashes_script
+    master = ctrl.masters['warden']
+    master_exec.expect = [
+        (shjoin(['sh', '-c', file_hashes_script, 'sh', '/a', '/b']), 0,
+         ('%s\n-\n' % content_hash('foo')).encode('ascii'), b'')]
+    assert master.file_hashes(['/a', '/b']) == {
+        '/a': content_hash('foo'), '/b': None}
+    master_exec.expect = [
+        (shjoin(['sh', '-c', file_hashes_script, 'sh', '/a']), 1, b'', b'')]
+    assert master.file_hashes(['/a']) == {'/a': None}
+    assert master.file_hashes([]) == {}
+
+
+def test_start_clone_errors(caplog):
+    from ploy_ezjail import benchmarks
+    fleet = benchmarks.SimulatedFleet(jails=3, new=2)
+    try:
+        master = fleet.masters[0]
+        host = fleet.hosts[master.id]
+        for name in fleet.new:
+            master.instances[name].config['ezjail-clone'] = 'tank/golden@base'
+        results = master.bulk(
+            'create', [master.instances[x] for x in fleet.new])
+        assert [x.error for x in results.values()] == [
+            "The 'ezjail-jailzfs' option of the master is needed to clone jails"] * 2
+        master.jail_zfs = 'tank/jails'
+        with pytest.raises(SystemExit):
+            master.instances['new'].start()
+        assert "cannot open 'tank/golden@base': dataset does not exist" in caplog_messages(caplog)
+        assert host.datasets == {}
+        assert 'new' not in host.jails
+    finally:
+        fleet.close()